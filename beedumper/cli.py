@@ -1,23 +1,25 @@
+# Only light modules are imported here so --help, --version and the
+# metadata commands start fast. requests, httpx, asyncio, pathos, PyYAML,
+# dateutil and pytz are imported by the functions that need them.
 from beedumper import VERSION
-from beedumper.export import Exporter
+from beedumper import serializer
+from beedumper.metrics import METRICS
+from beedumper.index import TicketIndex, index_exists, ticket_fingerprint, SYNCED
+from beedumper.download import BlobStore, download_file
+from beedumper.storage import FolderStorage, ArchiveStorage, KINDS, get_storage, ticket_folder
+from beedumper.shard import parse_shard, in_shard, shard_of, merge_export
 
 import sys
 import os
-import traceback
 import click
 from click import ClickException
 from pathlib import Path
 import logging
-import json
-from datetime import date
-from yaml import load, CLoader as Loader
-from pathos.multiprocessing import ProcessPool as Pool
-import re
-import requests
+import functools
+import time
+from collections import Counter
 
-from datetime import datetime
-import dateutil.parser
-import pytz
+from datetime import datetime, timezone
 
 logging.basicConfig(
     level=logging.WARNING,
@@ -29,18 +31,25 @@ logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
-TICKETS_PAGE = 100
 
 RESULTS_DOWNLOAD = 1
 RESULTS_SKIPPED = 2
 RESULTS_OLD = 3
+# Fetched again but unchanged, or not fetched as the ticket did not change
+RESULTS_UNCHANGED = 4
+
+FOLDER_STORAGE = FolderStorage()
+
+# Used to fetch every ticket regardless of its activity
+ALL_TIME = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
 class DownloadFiles(object):
-    __slots__ = 'downloaded', 'skipped',
+    __slots__ = 'downloaded', 'skipped', 'failed',
 
     def __init__(self):
         self.downloaded = 0
         self.skipped = 0
+        self.failed = 0
 
     def add_downloaded(self):
         self.downloaded += 1
@@ -48,7 +57,49 @@ class DownloadFiles(object):
     def add_skippped(self):
         self.skipped +=1
 
+    def add_failed(self):
+        self.failed += 1
+
+    def add(self, other):
+        self.downloaded += other.downloaded
+        self.skipped += other.skipped
+        self.failed += other.failed
+
+
+class Results(object):
+    """
+    Running totals of the tickets processed, updated as every ticket
+    completes so an interrupted export still reports what it did
+    """
+    def __init__(self):
+        self.processed = 0
+        self.statuses = Counter()
+        self.files = DownloadFiles()
+
+    def __len__(self):
+        return self.processed
+
+    def add(self, result):
+        self.processed += 1
+        if isinstance(result, DownloadFiles):
+            self.files.add(result)
+        else:
+            self.statuses[result] += 1
+
+    def echo(self, name):
+        if name == 'attachments':
+            click.echo('{} attachments written, {} skipped and {} failed'.format(
+                self.files.downloaded, self.files.skipped, self.files.failed))
+            return
+        writes = self.statuses[RESULTS_DOWNLOAD]
+        unchanged = self.statuses[RESULTS_UNCHANGED]
+        checked = self.statuses[RESULTS_SKIPPED] + unchanged + writes
+        click.echo('Wrote {} out of {} checked {} from {} processed tickets, {} writes avoided as unchanged'.format(
+            writes, checked, name, self.processed, unchanged))
+
 def get_folder_old(base_directory, ticket):
+    import dateutil.parser
+
     id = ticket['id']
     created = dateutil.parser.parse(ticket['created_at'])
 
@@ -62,22 +113,75 @@ def get_folder_old(base_directory, ticket):
     return id
 
 def get_folder(base_directory, ticket):
-    id = int(ticket['id'])
-    parent = base_directory.joinpath('tickets').joinpath(str(id % 99).zfill(2))
-    id_folder = parent.joinpath(str(id))
+    id_folder = ticket_folder(base_directory, ticket['id'])
     id_folder.mkdir(parents=True, exist_ok=True)
 
     return id_folder
 
 
-def save_ticket(base_directory, ticket):
-    destination_dir = get_folder(base_directory, ticket)
-    ticket_file = destination_dir.joinpath('ticket.json')
+def save_ticket(base_directory, ticket, index=None, storage=FOLDER_STORAGE):
+    """
+    Stores the ticket, returns False when it was already stored unchanged
+    """
+    destination_dir = ticket_folder(base_directory, ticket['id'])
+    written = storage.write(destination_dir, 'ticket', ticket)
+
+    if index is not None:
+        index.add(ticket, destination_dir)
+    return written
 
-    with ticket_file.open('w') as writer:
-        writer.write(json.dumps(ticket))
+def rebuild_index(base_directory, storage=FOLDER_STORAGE):
+    """
+    Writes the ticket index from the tickets stored
+    """
+    with TicketIndex(base_directory) as index:
+        for folder in storage.ticket_folders(base_directory):
+            index.add(storage.read(folder, 'ticket'), folder)
+        return len(index)
+
+def count_tickets(base_directory, since_date, storage=FOLDER_STORAGE, shard=None):
+    """
+    Number of tickets to process, indexing the tickets stored the first time
+    """
+    if not index_exists(base_directory):
+        if not storage.has_tickets(base_directory):
+            return 0
+        click.echo('Indexing the tickets already exported...')
+        rebuild_index(base_directory, storage)
+    with TicketIndex(base_directory) as index:
+        return index.count(since_date, shard=shard)
+
+def iter_tickets(base_directory, since_date, change_detection=True, shard=None):
+    """
+    Yields (ticket_file, ticket_obj) to process from the ticket index.
+    Without change detection the stubs don't report any resource in sync.
+
+    The index is opened on the first item so the generator can be consumed
+    from the thread feeding the pool workers.
+    """
+    if not index_exists(base_directory):
+        return
+    with TicketIndex(base_directory) as index:
+        for ticket_file, ticket_obj in index.tickets(since_date, shard=shard):
+            if not change_detection:
+                ticket_obj['synced'] = []
+            yield ticket_file, ticket_obj
+
+def record_synced(index, resource):
+    """
+    Result callback storing the fingerprint of the tickets whose resource
+    was saved, or found unchanged
+    """
+    def done(ticket, result):
+        ticket_file, ticket_obj = ticket
+        if result in (RESULTS_DOWNLOAD, RESULTS_UNCHANGED) and ticket_obj.get('fingerprint'):
+            index.mark_synced(ticket_obj['id'], resource, ticket_obj['fingerprint'])
+    return done
 
 def check_ticket_activity(ticket_obj, since_date):
+    import dateutil.parser
+    import pytz
+
     if 'last_activity_at' in ticket_obj and ticket_obj['last_activity_at'] != None:
         last_activity = dateutil.parser.parse(ticket_obj['last_activity_at'])
     else:
@@ -85,24 +189,25 @@ def check_ticket_activity(ticket_obj, since_date):
 
     return last_activity > since_date
 
-def save_replies(exporter, ticket_file, since_date, force):
+def save_replies(exporter, ticket_file, since_date, force, ticket_obj=None, storage=FOLDER_STORAGE):
     try:
-        with ticket_file.open('r') as reader:
-            ticket_obj = json.loads(reader.read())
+        if ticket_obj is None:
+            ticket_obj = storage.read(ticket_file.parent, 'ticket')
 
         if check_ticket_activity(ticket_obj, since_date):
             parent = ticket_file.parent
-            replies_file = parent.joinpath('replies.json')
-            if force or not replies_file.exists():
+            if force and 'replies' in ticket_obj.get('synced', []) and storage.exists(parent, 'replies'):
+                logger.debug('Skipping replies of the unchanged ticket {}'.format(parent.name))
+                return RESULTS_UNCHANGED
+            if force or not storage.exists(parent, 'replies'):
                 id = parent.name
                 logger.debug('Saving replies for ticket {}'.format(id))
                 # Get the replies for this ticket
                 replies = exporter.get_replies(id)
                 # Store the result
-                with replies_file.open('w') as writer:
-                    content = json.dumps(replies)
-                    writer.write(content)
+                if storage.write(parent, 'replies', replies):
                     return RESULTS_DOWNLOAD
+                return RESULTS_UNCHANGED
             else:
                 logger.debug('Skipping download reply {}'.format(parent.name))
                 return RESULTS_SKIPPED
@@ -111,24 +216,25 @@ def save_replies(exporter, ticket_file, since_date, force):
     except Exception as e:
         logger.error(e)
 
-def save_comments(exporter, ticket_file, since_date, force):
+def save_comments(exporter, ticket_file, since_date, force, ticket_obj=None, storage=FOLDER_STORAGE):
     try:
-        with ticket_file.open('r') as reader:
-            ticket_obj = json.loads(reader.read())
+        if ticket_obj is None:
+            ticket_obj = storage.read(ticket_file.parent, 'ticket')
             
         if check_ticket_activity(ticket_obj, since_date):
             parent = ticket_file.parent
-            comments_file = parent.joinpath('comments.json')
             id = parent.name
-            if force or not comments_file.exists():
+            if force and 'comments' in ticket_obj.get('synced', []) and storage.exists(parent, 'comments'):
+                logger.debug('Skipping comments of the unchanged ticket {}'.format(parent.name))
+                return RESULTS_UNCHANGED
+            if force or not storage.exists(parent, 'comments'):
                 logger.debug('Saving comments for ticket {}'.format(id))
                 # Get the comments for this ticket
                 comments = exporter.get_comments(id)
                 # Store the result
-                with comments_file.open('w') as writer:
-                    content = json.dumps(comments)
-                    writer.write(content)
+                if storage.write(parent, 'comments', comments):
                     return RESULTS_DOWNLOAD
+                return RESULTS_UNCHANGED
             else:
                 logger.debug('Skipping comments for ticket {}...'.format(id))
                 return RESULTS_SKIPPED
@@ -137,71 +243,456 @@ def save_comments(exporter, ticket_file, since_date, force):
     except Exception as e:
         logger.error('Error when processing ticket {}\r\n{}'.format(ticket_file.parent,str(e)))
 
-def save_attachments(token, timeout, ticket_file, since_date, force=False):
-    with ticket_file.open('r') as reader:
-        ticket_obj = json.loads(reader.read())
-    
+def get_attachment_jobs(parent, ticket_obj, storage=FOLDER_STORAGE):
+    """
+    Returns the list of (url, file) attachments of a ticket and its replies
+    """
+    jobs = []
+    attachments_folder = parent.joinpath('attachments')
+    r_attachments_folder = parent.joinpath('attachments_replies')
+
+    for attachment in ticket_obj['content']['attachments']:
+        jobs.append((attachment['url']['original'], attachments_folder.joinpath(attachment['filename'])))
+
+    if storage.exists(parent, 'replies'):
+        replies_obj = storage.read(parent, 'replies')
+        for reply in replies_obj:
+            if 'content' in reply:
+                for attachment in reply['content']['attachments']:
+                    jobs.append((attachment['url']['original'], r_attachments_folder.joinpath(attachment['filename'])))
+
+    logger.debug('{} attachments to download'.format(len(jobs)))
+    return jobs
+
+def check_ticket(ticket_file, ticket_obj=None, storage=FOLDER_STORAGE):
+    """
+    Returns what is missing of an exported ticket: its replies or comments
+    and the attachment files
+    """
+    parent = ticket_file.parent
+    if ticket_obj is None or 'content' not in ticket_obj:
+        ticket_obj = storage.read(parent, 'ticket')
+
+    missing = [kind for kind in ['replies', 'comments'] if not storage.exists(parent, kind)]
+    for url, attachment_file in get_attachment_jobs(parent, ticket_obj, storage):
+        if not attachment_file.exists():
+            missing.append(str(attachment_file.relative_to(parent)))
+    return missing
+
+def repair_ticket(exporter, folder, problems, storage, index, store=None, session=None):
+    """
+    Fetches again the broken documents of a ticket, then downloads its
+    attachments missing or of the wrong size, including the ones of the
+    replies just fetched, with the session given and not the API one
+    """
+    from beedumper.export import download_with_retries
+    from beedumper.verify import verify_ticket
+
+    config = exporter.get_config()
+    id = folder.name
+    kinds = set(problem['kind'] for problem in problems)
+    if 'ticket' in kinds:
+        ticket = exporter.get_ticket(id)
+        storage.write(folder, 'ticket', ticket)
+        index.add(ticket, folder)
+    if 'replies' in kinds:
+        storage.write(folder, 'replies', exporter.get_replies(id))
+    if 'comments' in kinds:
+        storage.write(folder, 'comments', exporter.get_comments(id))
+
+    for problem in verify_ticket(folder, storage):
+        if problem['kind'] == 'attachment':
+            attachment_file = folder.joinpath(problem['path'])
+            attachment_file.parent.mkdir(parents=True, exist_ok=True)
+            download_with_retries(exporter.limiter, problem['url'], attachment_file, config.get('timeout'), store,
+                                  session, params={'auth_token': config['token']})
+
+def save_attachments(token, timeout, ticket_file, since_date, force=False, ticket_obj=None, store=None, session=None, storage=FOLDER_STORAGE, limiter=None):
+    """
+    Downloads the attachments of a ticket, retrying them through the
+    limiter when given
+    """
+    from beedumper.export import download_with_retries
+
+    results = DownloadFiles()
+    # A ticket or replies that don't load fail the ticket, not the run
+    try:
+        if ticket_obj is None or 'content' not in ticket_obj:
+            ticket_obj = storage.read(ticket_file.parent, 'ticket')
+        jobs = get_attachment_jobs(ticket_file.parent, ticket_obj, storage) \
+            if check_ticket_activity(ticket_obj, since_date) else []
+    except Exception as e:
+        results.add_failed()
+        logger.error('Error when processing ticket {}\r\n{}'.format(ticket_file.parent,str(e)))
+        return results
+
+    for url, attachment_file in jobs:
+        try:
+            if force or not attachment_file.exists():
+                attachment_file.parent.mkdir(parents=True, exist_ok=True)
+                if limiter is not None:
+                    download_with_retries(limiter, url, attachment_file, timeout, store, session,
+                                          params={'auth_token': token})
+                else:
+                    download_file(url, attachment_file, timeout, store, session, params={'auth_token': token})
+                results.add_downloaded()
+            else:
+                logger.debug('Skipping {}'.format(str(attachment_file)))
+                results.add_skippped()
+
+        except Exception as e:
+            results.add_failed()
+            logger.error('Error when processing attachment {}\r\n{}'.format(url,str(e)))
+    return results
+
+async def async_save_replies(exporter, ticket_file, since_date, force, ticket_obj=None, storage=FOLDER_STORAGE):
+    try:
+        if ticket_obj is None:
+            ticket_obj = storage.read(ticket_file.parent, 'ticket')
+
+        if check_ticket_activity(ticket_obj, since_date):
+            parent = ticket_file.parent
+            if force and 'replies' in ticket_obj.get('synced', []) and storage.exists(parent, 'replies'):
+                logger.debug('Skipping replies of the unchanged ticket {}'.format(parent.name))
+                return RESULTS_UNCHANGED
+            if force or not storage.exists(parent, 'replies'):
+                id = parent.name
+                logger.debug('Saving replies for ticket {}'.format(id))
+                replies = await exporter.get_replies(id)
+                if storage.write(parent, 'replies', replies):
+                    return RESULTS_DOWNLOAD
+                return RESULTS_UNCHANGED
+            else:
+                logger.debug('Skipping download reply {}'.format(parent.name))
+                return RESULTS_SKIPPED
+        else:
+            return RESULTS_OLD
+    except Exception as e:
+        logger.error('Error when processing ticket {}\r\n{}'.format(ticket_file.parent,str(e)))
+
+async def async_save_comments(exporter, ticket_file, since_date, force, ticket_obj=None, storage=FOLDER_STORAGE):
+    try:
+        if ticket_obj is None:
+            ticket_obj = storage.read(ticket_file.parent, 'ticket')
+
+        if check_ticket_activity(ticket_obj, since_date):
+            parent = ticket_file.parent
+            id = parent.name
+            if force and 'comments' in ticket_obj.get('synced', []) and storage.exists(parent, 'comments'):
+                logger.debug('Skipping comments of the unchanged ticket {}'.format(parent.name))
+                return RESULTS_UNCHANGED
+            if force or not storage.exists(parent, 'comments'):
+                logger.debug('Saving comments for ticket {}'.format(id))
+                comments = await exporter.get_comments(id)
+                if storage.write(parent, 'comments', comments):
+                    return RESULTS_DOWNLOAD
+                return RESULTS_UNCHANGED
+            else:
+                logger.debug('Skipping comments for ticket {}...'.format(id))
+                return RESULTS_SKIPPED
+        else:
+            return RESULTS_OLD
+    except Exception as e:
+        logger.error('Error when processing ticket {}\r\n{}'.format(ticket_file.parent,str(e)))
+
+async def async_save_attachments(exporter, ticket_file, since_date, force=False, ticket_obj=None, store=None, storage=FOLDER_STORAGE):
     results = DownloadFiles()
-        
-    if check_ticket_activity(ticket_obj, since_date):
-        parent = ticket_file.parent
-        attachments_folder = parent.joinpath('attachments')
-        r_attachments_folder = parent.joinpath('attachments_replies')
-
-        attachments = ticket_obj['content']['attachments']
-
-        if len(attachments) > 0:
-            logger.debug('{} attachments to download'.format(len(attachments)))
-            attachments_folder.mkdir(exist_ok=True)
-            for attachment in attachments:
-                url = attachment['url']['original'] + \
-                    '?auth_token={0}'.format(token)
-                fname = attachment['filename']
-                attachment_file = attachments_folder.joinpath(fname)
-
-                try:
-                    if force or not attachment_file.exists():
-                        r = requests.get(url, timeout=timeout)
-                        with attachment_file.open('wb') as writer:
-                            writer.write(r.content)
-                        results.add_downloaded()
-
-                    else:
-                        logger.debug('Skipping {}'.format(str(attachment_file)))
-                        results.add_skippped()
-
-                except Exception as e:
-                    logger.error('Error when processing attachment {}\r\n{}'.format(url,str(e)))
-
-        replies_file = parent.joinpath('replies.json')
-        if replies_file.exists():
-            with replies_file.open('r') as reader:
-                replies_obj = json.loads(reader.read())
-                for reply in replies_obj:
-                    if 'content' in reply:
-                        r_attachments = reply['content']['attachments']
-                        if len(r_attachments) > 0:
-                            logger.debug('{} reply attachments to download'.format(len(r_attachments)))
-                            r_attachments_folder.mkdir(exist_ok=True)
-                            for attachment in r_attachments:
-                                url = attachment['url']['original'] + \
-                                    '?auth_token={0}'.format(token)
-                                fname = attachment['filename']
-                                attachment_file = r_attachments_folder.joinpath(fname)
-                                try:
-                                    if force or not attachment_file.exists():
-                                        r = requests.get(url, timeout=timeout)
-                                        with attachment_file.open('wb') as writer:
-                                            writer.write(r.content)
-                                        results.add_downloaded()
-                                    else:
-                                        logger.debug('Skipping {}'.format(str(attachment_file)))
-                                        results.add_skippped()
-                                except Exception as e:
-                                    logger.error('Error when processing attachment {}\r\n{}'.format(url,str(e)))
+    try:
+        if ticket_obj is None or 'content' not in ticket_obj:
+            ticket_obj = storage.read(ticket_file.parent, 'ticket')
+        jobs = get_attachment_jobs(ticket_file.parent, ticket_obj, storage) \
+            if check_ticket_activity(ticket_obj, since_date) else []
+    except Exception as e:
+        results.add_failed()
+        logger.error('Error when processing ticket {}\r\n{}'.format(ticket_file.parent,str(e)))
+        return results
+
+    for url, attachment_file in jobs:
+        try:
+            if force or not attachment_file.exists():
+                attachment_file.parent.mkdir(parents=True, exist_ok=True)
+                await exporter.download(url, attachment_file, store)
+                results.add_downloaded()
+            else:
+                logger.debug('Skipping {}'.format(str(attachment_file)))
+                results.add_skippped()
+        except Exception as e:
+            results.add_failed()
+            logger.error('Error when processing attachment {}\r\n{}'.format(url,str(e)))
     return results
 
+def run_async(config, func, tickets, total, results, done=None):
+    """
+    Runs the coroutine function over the tickets with a single
+    AsyncExporter, adding every result to `results` as it completes and
+    calling `done(ticket, result)` when given
+    """
+    import asyncio
+    from beedumper.export import AsyncExporter, bounded_map
+
+    async def runner():
+        async with AsyncExporter(config) as exporter:
+            async def save(ticket):
+                return ticket, await func(exporter, ticket)
+            with click.progressbar(length=total, label='Processing tickets') as bar:
+                async for ticket, result in bounded_map(save, tickets, exporter.concurrency):
+                    results.add(result)
+                    if done is not None:
+                        done(ticket, result)
+                    bar.update(1)
+        echo_connection_stats(exporter.connection_stats())
+
+    asyncio.run(runner())
+
+def run_pool(config, func, tickets, total, results, done=None):
+    """
+    Runs the function over the tickets with a pool of `download_threads`
+    processes. Tickets are sent in chunks of `pool_chunksize` and the
+    results are added to `results` in completion order, so neither the
+    tickets nor the results are ever held in a list.
+    """
+    from pathos.multiprocessing import ProcessPool as Pool
+
+    def save(ticket):
+        return ticket, func(ticket)
+
+    with Pool(config['download_threads']) as p, \
+         click.progressbar(length=total, label='Processing tickets') as bar:
+        for ticket, result in p.uimap(save, tickets, chunksize=config.get('pool_chunksize', 10)):
+            results.add(result)
+            if done is not None:
+                done(ticket, result)
+            bar.update(1)
+
+def echo_connection_stats(stats):
+    for host, host_stats in sorted(stats.items()):
+        if host_stats['connections'] > 0:
+            click.echo('{}: {} requests over {} connections ({:.1f} requests per connection)'.format(
+                host, host_stats['requests'], host_stats['connections'],
+                host_stats['requests'] / host_stats['connections']))
+
+def merge_connection_stats(*all_stats):
+    merged = {}
+    for stats in all_stats:
+        for host, host_stats in stats.items():
+            host_merged = merged.setdefault(host, {'requests': 0, 'connections': 0})
+            host_merged['requests'] += host_stats['requests']
+            host_merged['connections'] += host_stats['connections']
+    return merged
+
+# One pooled session per worker process for the attachment downloads
+worker_session = None
+# And one rate limiter, every worker downloads a file at a time
+worker_limiter = None
+
+def get_worker_session(config):
+    from beedumper.export import make_session
+
+    global worker_session
+    if worker_session is None:
+        worker_session = make_session(config)
+    return worker_session
+
+def get_worker_limiter(config):
+    from beedumper.ratelimit import RateLimiter
+
+    global worker_limiter
+    if worker_limiter is None:
+        worker_limiter = RateLimiter(config, 1)
+    return worker_limiter
+
+def run_pipeline(obj, since_date, force_replies, force_comments, force_attachments, state=None, storage=FOLDER_STORAGE, shard=None):
+    """
+    Single pass export: every page of tickets is saved and its tickets are
+    queued for the replies, comments and attachments workers that run at
+    the same time. Attachments are queued once the replies are stored.
+
+    With a SyncState the force flags are ignored: only the sub resources
+    out of date are fetched, including the ones of tickets left stale by
+    previous runs, and of their attachments only the missing ones.
+
+    With a shard every ticket is saved but only the ones of the shard are
+    queued for the sub resources.
+    """
+    import asyncio
+    from beedumper.export import AsyncExporter
+
+    config = obj.get_config()
+    EXPORT_FOLDER = Path(config['export_folder'])
+    EXPORT_FOLDER.mkdir(parents=True, exist_ok=True)
+
+    if not index_exists(EXPORT_FOLDER) and storage.has_tickets(EXPORT_FOLDER):
+        rebuild_index(EXPORT_FOLDER, storage)
+
+    store = BlobStore(EXPORT_FOLDER) if config.get('attachments_store') else None
+    change_detection = config.get('change_detection', True)
+    save_attachments_to_store = functools.partial(async_save_attachments, store=store)
+
+    async def runner():
+        results = {'tickets': 0, 'tickets_unchanged': 0, 'replies': Results(), 'comments': Results(), 'attachments': Results()}
+
+        with TicketIndex(EXPORT_FOLDER) as index:
+            async with AsyncExporter(config) as exporter:
+                await run_stages(exporter, index, results)
+
+        results['connections'] = merge_connection_stats(obj.connection_stats(), exporter.connection_stats())
+        return results
+
+    async def report_progress(results, queues):
+        """
+        Prints the counts and queue depths every `progress_interval` seconds
+        """
+        interval = config.get('progress_interval', 5)
+        while True:
+            await asyncio.sleep(interval)
+            for stage, queue in queues.items():
+                METRICS.set('queue_depth', queue.qsize(), stage=stage)
+            click.echo('{} tickets, {} replies, {} comments, {} attachments | queued {}'.format(
+                results['tickets'], len(results['replies']), len(results['comments']), len(results['attachments']),
+                ', '.join('{} {}'.format(queue.qsize(), stage) for stage, queue in queues.items())), err=True)
+
+    async def run_stages(exporter, index, results):
+        loop = asyncio.get_event_loop()
+        workers = exporter.concurrency
+        replies_q = asyncio.Queue(maxsize=workers * 2)
+        comments_q = asyncio.Queue(maxsize=workers * 2)
+        attachments_q = asyncio.Queue(maxsize=workers * 2)
+        for stage in ['replies', 'comments', 'attachments']:
+            METRICS.add_workers(stage, workers)
+
+        async def produce():
+            seen = set()
+            pages = obj.get_tickets(since_date=since_date.isoformat(), ordered=False)
+            while True:
+                # Pages are fetched and decoded by the blocking exporter off the loop
+                page = await loop.run_in_executor(None, next, pages, None)
+                if page is None:
+                    break
+                tickets = iter(page)
+                while True:
+                    ticket = await loop.run_in_executor(None, next, tickets, None)
+                    if ticket is None:
+                        break
+                    if not save_ticket(EXPORT_FOLDER, ticket, index, storage):
+                        results['tickets_unchanged'] += 1
+                    results['tickets'] += 1
+                    if not in_shard(ticket['id'], shard):
+                        continue
+                    if state is not None:
+                        state.update_ticket(ticket)
+                        seen.add(int(ticket['id']))
+                    await replies_q.put(ticket)
+                    await comments_q.put(ticket)
+                logger.info('Tickets {} to {} downloaded'.format(page.offset, page.offset + page.count))
+                index.commit()
+                if state is not None:
+                    state.commit()
+
+            if state is not None:
+                # Retry the tickets that failed on previous runs
+                for id in state.stale_tickets():
+                    if id not in seen and in_shard(id, shard):
+                        ticket = storage.read(ticket_folder(EXPORT_FOLDER, id), 'ticket')
+                        results['tickets'] += 1
+                        await replies_q.put(ticket)
+                        await comments_q.put(ticket)
+
+            for _ in range(workers):
+                await replies_q.put(None)
+                await comments_q.put(None)
+
+        async def process(resource, save, ticket, force):
+            ticket_file = ticket_folder(EXPORT_FOLDER, ticket['id']).joinpath('ticket.json')
+            if state is None:
+                detect = change_detection and force and resource in SYNCED
+                if detect and index.is_synced(ticket['id'], resource) and storage.exists(ticket_file.parent, resource):
+                    return RESULTS_UNCHANGED
+                result = await save(exporter, ticket_file, since_date, force, ticket_obj=ticket, storage=storage)
+                if detect and result in (RESULTS_DOWNLOAD, RESULTS_UNCHANGED):
+                    index.mark_synced(ticket['id'], resource, ticket_fingerprint(ticket))
+                return result
+
+            if not state.is_stale(ticket['id'], resource):
+                return DownloadFiles() if resource == 'attachments' else RESULTS_SKIPPED
+
+            fetched = time.time()
+            # Attachments already on disk never change, only the new ones are downloaded
+            result = await save(exporter, ticket_file, ALL_TIME, resource != 'attachments', ticket_obj=ticket,
+                                storage=storage)
+            # Fetched fine even if nothing changed and the write was avoided
+            if result in (RESULTS_DOWNLOAD, RESULTS_UNCHANGED, RESULTS_SKIPPED) or \
+                    (isinstance(result, DownloadFiles) and result.failed == 0):
+                state.mark_fetched(ticket['id'], resource, fetched)
+            return result
+
+        async def timed(resource, save, ticket, force):
+            started = time.time()
+            try:
+                return await process(resource, save, ticket, force)
+            finally:
+                METRICS.busy(resource, time.time() - started)
+                METRICS.inc('tickets_processed', stage=resource)
+
+        async def replies_worker():
+            while True:
+                ticket = await replies_q.get()
+                if ticket is None:
+                    return
+                results['replies'].add(await timed('replies', async_save_replies, ticket, force_replies))
+                await attachments_q.put(ticket)
+
+        async def comments_worker():
+            while True:
+                ticket = await comments_q.get()
+                if ticket is None:
+                    return
+                results['comments'].add(await timed('comments', async_save_comments, ticket, force_comments))
+
+        async def attachments_worker():
+            while True:
+                ticket = await attachments_q.get()
+                if ticket is None:
+                    return
+                results['attachments'].add(await timed('attachments', save_attachments_to_store, ticket, force_attachments))
+
+        async def replies_stage():
+            await asyncio.gather(*[replies_worker() for _ in range(workers)])
+            for _ in range(workers):
+                await attachments_q.put(None)
+
+        progress = asyncio.ensure_future(report_progress(
+            results, {'replies': replies_q, 'comments': comments_q, 'attachments': attachments_q}))
+        try:
+            await asyncio.gather(
+                produce(),
+                replies_stage(),
+                *[comments_worker() for _ in range(workers)],
+                *[attachments_worker() for _ in range(workers)])
+        finally:
+            progress.cancel()
+            for stage, queue in [('replies', replies_q), ('comments', comments_q), ('attachments', attachments_q)]:
+                METRICS.set('queue_depth', queue.qsize(), stage=stage)
+
+    return asyncio.run(runner())
+
+def echo_pipeline_results(results):
+    click.echo('{} tickets processed, {} writes avoided as unchanged'.format(results['tickets'], results['tickets_unchanged']))
+    for name in ['replies', 'comments', 'attachments']:
+        results[name].echo(name)
+    echo_connection_stats(results['connections'])
+
+def validate_shard(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
 def validate_date(ctx, param, value):
+    import dateutil.parser
+    import pytz
+
     try:
         if value:
             return pytz.utc.localize(dateutil.parser.parse(value))
@@ -215,9 +706,11 @@ def validate_date(ctx, param, value):
 @click.group(context_settings=CONTEXT_SETTINGS)
 @click.option('-l', '--loglevel', type=click.Choice(['error', 'warn', 'info', 'debug']), default='warn')
 @click.option('-c', '--config', type=click.Path(exists=True), default=os.path.realpath('config.yaml'), help="Defaults to current folder \"config.yaml\"")
+@click.option('--metrics', type=click.Path(dir_okay=False), help="Write the run metrics to this file, Prometheus format if it ends with .prom, JSON otherwise")
+@click.option('--profile', type=click.Path(dir_okay=False), help="Profile the command and write the cProfile stats to this file")
 @click.version_option(VERSION, '--version', '-v')
 @click.pass_context
-def cli(ctx, loglevel, config):
+def cli(ctx, loglevel, config, metrics, profile):
     """
     This command line tool helps you export your SupportBee account data.
     """
@@ -239,92 +732,87 @@ def cli(ctx, loglevel, config):
         # by means other than the `if` block below
         ctx.ensure_object(dict)
 
+        from yaml import load, CLoader as Loader
+        from beedumper.export import Exporter
+
         config_file = Path(config)
         with config_file.open('r') as config_reader:
             config = load(config_reader.read(), Loader=Loader)['SupportBee']
 
         ctx.obj['exporter'] = Exporter(config)
+        ctx.obj['storage'] = get_storage(config)
 
+        if metrics:
+            ctx.call_on_close(lambda: METRICS.write(metrics))
+        if profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+            ctx.call_on_close(lambda: write_profile(profiler, profile))
 
-@cli.command(help="Exports the users")
-@click.pass_context
-def users(ctx):
+
+def write_profile(profiler, path):
+    """
+    Dumps the stats, loadable with pstats or snakeviz, and prints the
+    functions taking most of the time
+    """
+    import pstats
+
+    profiler.disable()
+    profiler.dump_stats(path)
+    stats = pstats.Stats(profiler, stream=sys.stderr)
+    stats.sort_stats('cumulative').print_stats(20)
+
+
+def export_metadata(exporter, name):
+    """
+    Streams the pages of a metadata endpoint to <name>.json in the export
+    folder, returns the number of items and the file
+    """
+    EXPORT_FOLDER = Path(exporter.get_config()['export_folder'])
+    EXPORT_FOLDER.mkdir(parents=True, exist_ok=True)
+    metadata_file = EXPORT_FOLDER.joinpath(name + '.json')
+    total = serializer.dump_list_file(metadata_file, exporter.iter_metadata(name))
+    return total, metadata_file
+
+def run_metadata_command(ctx, name):
     obj = ctx.obj['exporter']
     try:
-        users = obj.get_users()
-        EXPORT_FOLDER = Path(obj.get_config()['export_folder'])
-        users_file = EXPORT_FOLDER.joinpath('users.json')
-        with users_file.open('w') as writer:
-            writer.write(json.dumps(users))
-        click.echo('{} users exported to {}'.format(len(users),  click.format_filename(str(users_file))))
-
+        total, metadata_file = export_metadata(obj, name)
+        click.echo('{} {} exported to {}'.format(total, name, click.format_filename(str(metadata_file))))
     except Exception as e:
         click.secho(str(e), fg='red')
         ctx.abort()
 
 
+@cli.command(help="Exports the users")
+@click.pass_context
+def users(ctx):
+    run_metadata_command(ctx, 'users')
+
+
 @cli.command(help="Exports the labels")
 @click.pass_context
 def labels(ctx):
-    obj = ctx.obj['exporter']
-    try:
-        labels = obj.get_labels()
-        EXPORT_FOLDER = Path(obj.get_config()['export_folder'])
-        labels_file = EXPORT_FOLDER.joinpath('labels.json')
-        with labels_file.open('w') as writer:
-            writer.write(json.dumps(labels))
-        click.echo('{} labels exported to {}'.format(len(labels), click.format_filename(str(labels_file))))
-    except Exception as e:
-        click.secho(str(e), fg='red')
-        ctx.abort()
+    run_metadata_command(ctx, 'labels')
 
 
 @cli.command(help="Exports the teams")
 @click.pass_context
 def teams(ctx):
-    obj = ctx.obj['exporter']
-    try:
-        teams = obj.get_teams()
-        EXPORT_FOLDER = Path(obj.get_config()['export_folder'])
-        teams_file = EXPORT_FOLDER.joinpath('teams.json')
-        with teams_file.open('w') as writer:
-            writer.write(json.dumps(teams))
-        click.echo('{} teams exported to {}'.format(len(teams), click.format_filename(str(teams_file))))
-    except Exception as e:
-        click.secho(str(e), fg='red')
-        ctx.abort()
+    run_metadata_command(ctx, 'teams')
 
 
 @cli.command(help="Exports the snippets")
 @click.pass_context
 def snippets(ctx):
-    obj = ctx.obj['exporter']
-    try:
-        snippets = obj.get_snippets()
-        EXPORT_FOLDER = Path(obj.get_config()['export_folder'])
-        snippets_file = EXPORT_FOLDER.joinpath('snippets.json')
-        with snippets_file.open('w') as writer:
-            writer.write(json.dumps(snippets))
-        click.echo('{} snippets exported to {}'.format(len(snippets), click.format_filename(str(snippets_file))))
-    except Exception as e:
-        click.secho(str(e), fg='red')
-        ctx.abort()
+    run_metadata_command(ctx, 'snippets')
 
 
 @cli.command(help="Exports the forwarding addresses")
 @click.pass_context
 def emails(ctx):
-    obj = ctx.obj['exporter']
-    try:
-        emails = obj.get_emails()
-        EXPORT_FOLDER = Path(obj.get_config()['export_folder'])
-        emails_file = EXPORT_FOLDER.joinpath('emails.json')
-        with emails_file.open('w') as writer:
-            writer.write(json.dumps(emails))
-        click.echo('{} emails exported to {}'.format(len(emails),  click.format_filename(str(emails_file))))
-    except Exception as e:
-        click.secho(str(e), fg='red')
-        ctx.abort()
+    run_metadata_command(ctx, 'emails')
 
 
 @cli.command(help="Exports all tickets in a folder structure")
@@ -337,127 +825,448 @@ def export_tickets(ctx, since_date):
     # Create the base folder if it does not exist
     EXPORT_FOLDER.mkdir(parents=True, exist_ok=True)
     
-    tickets_iterator = obj.get_tickets(per_page=TICKETS_PAGE, since_date=since_date.isoformat())
-
-    result = next(tickets_iterator)
-    click.echo('{} pages of {} tickets each to download'.format(result.total_pages, TICKETS_PAGE))
-    with click.progressbar(length= result.total_pages * TICKETS_PAGE,
-                        label='Downloading tickets') as bar:
-        while result:
-            bar.update(result.page * TICKETS_PAGE)
-            tickets = result.data
-            # click.echo('{:3d}|{:3d}|{:3d}'.format(result.page, result.total_pages, len(tickets)))
-            for ticket in tickets:
-                save_ticket(EXPORT_FOLDER, ticket)
-            
-            result = next(tickets_iterator, False)
+    STORAGE = ctx.obj['storage']
+
+    if not index_exists(EXPORT_FOLDER) and STORAGE.has_tickets(EXPORT_FOLDER):
+        click.echo('Indexing the tickets already exported...')
+        rebuild_index(EXPORT_FOLDER, STORAGE)
+
+    counts = Counter()
+
+    def save_page(page, index):
+        # Tickets are written as they are decoded from the response
+        for ticket in page:
+            counts['written' if save_ticket(EXPORT_FOLDER, ticket, index, STORAGE) else 'unchanged'] += 1
+        index.commit()
+        return page.count
+
+    pages = obj.get_tickets(since_date=since_date.isoformat())
+    with TicketIndex(EXPORT_FOLDER) as index:
+        first = next(pages)
+        saved = save_page(first, index)
+        total = max(first.total or 0, saved)
+        click.echo('{} tickets to download'.format(total))
+        with click.progressbar(length=total, label='Downloading tickets') as bar:
+            bar.update(saved)
+            for page in pages:
+                bar.update(save_page(page, index))
+
+    written, unchanged = counts['written'], counts['unchanged']
+    click.echo('{} tickets written, {} writes avoided as unchanged'.format(written, unchanged))
+    echo_connection_stats(obj.connection_stats())
+
+@cli.command(help="Rebuilds the ticket index from the tickets stored")
+@click.pass_context
+def build_index(ctx):
+    obj = ctx.obj['exporter']
+    EXPORT_FOLDER = Path(obj.get_config()['export_folder'])
+    total = rebuild_index(EXPORT_FOLDER, ctx.obj['storage'])
+    click.echo('{} tickets indexed'.format(total))
+
+@cli.command(help="Converts the tickets stored in folders to the archive storage")
+@click.option('-d', '--delete', is_flag=True, help="Delete the JSON files once converted")
+@click.pass_context
+def convert(ctx, delete):
+    obj = ctx.obj['exporter']
+    config = obj.get_config()
+    EXPORT_FOLDER = Path(config['export_folder'])
+    folders = FolderStorage()
+    archive = ArchiveStorage(EXPORT_FOLDER, config.get('storage_compression', 'zstd'))
+
+    total = 0
+    for folder in list(folders.ticket_folders(EXPORT_FOLDER)):
+        for kind in KINDS:
+            if folders.exists(folder, kind):
+                archive.write(folder, kind, folders.read(folder, kind))
+                if delete:
+                    folders.path(folder, kind).unlink()
+        if delete:
+            try:
+                # Only removed when there are no attachments
+                folder.rmdir()
+            except OSError:
+                pass
+        total += 1
+    archive.close()
+
+    click.echo('{} tickets converted to {}'.format(total, click.format_filename(str(archive.path))))
+    if config.get('storage', 'folder') != 'archive':
+        click.echo('Set "storage: archive" in your configuration to use it')
+
+@cli.command(name='index', help="Builds or updates the search index of the tickets stored")
+@click.pass_context
+def search_index(ctx):
+    from beedumper.search import SearchIndex
+
+    obj = ctx.obj['exporter']
+    EXPORT_FOLDER = Path(obj.get_config()['export_folder'])
+    STORAGE = ctx.obj['storage']
+
+    total = count_tickets(EXPORT_FOLDER, None, STORAGE)
+    folders = (ticket_file.parent for ticket_file, ticket_obj in iter_tickets(EXPORT_FOLDER, None))
+    with SearchIndex(EXPORT_FOLDER) as index, \
+         click.progressbar(length=total, label='Indexing tickets') as bar:
+        indexed, unchanged, removed = index.update(folders, STORAGE, bar.update)
+    click.echo('{} tickets indexed, {} unchanged and {} removed'.format(indexed, unchanged, removed))
+
+@cli.command(help="Searches the tickets stored, run index first")
+@click.argument('text', required=False)
+@click.option('-r', '--requester', help="Requester name, or email for an exact match")
+@click.option('--label', help="Label of the tickets")
+@click.option('-s', '--since-date', callback=validate_date, help="Tickets created since this date, example: 2017-11-28")
+@click.option('-u', '--until-date', callback=validate_date, help="Tickets created before this date")
+@click.option('-n', '--limit', type=click.IntRange(1), default=20, help="Maximum number of tickets")
+@click.option('--json', 'as_json', is_flag=True, help="Print a JSON object per ticket")
+@click.pass_context
+def search(ctx, text, requester, label, since_date, until_date, limit, as_json):
+    """
+    TEXT uses the SQLite FTS5 syntax: words, "phrases", OR, NOT, prefix*
+    or a column like replies:word, from subject, body, replies, comments
+    and requester.
+    """
+    import sqlite3
+    from beedumper.search import SearchIndex, SEARCH_FILE
+
+    obj = ctx.obj['exporter']
+    EXPORT_FOLDER = Path(obj.get_config()['export_folder'])
+    if not EXPORT_FOLDER.joinpath(SEARCH_FILE).exists():
+        raise ClickException('There is no search index, run the index command first')
+
+    with SearchIndex(EXPORT_FOLDER) as index:
+        try:
+            for ticket in index.search(text, requester, label, since_date, until_date, limit):
+                if as_json:
+                    click.echo(serializer.dumps(ticket).decode('utf-8'))
+                    continue
+                click.echo('{}  {}  {} <{}>  {}'.format(
+                    ticket['id'], (ticket['created_at'] or '')[:10], ticket['requester']['name'],
+                    ticket['requester']['email'], ticket['subject']))
+                if ticket['snippet']:
+                    click.echo('    {}'.format(ticket['snippet'].replace('\n', ' ')))
+        except sqlite3.OperationalError as e:
+            raise ClickException('Invalid search: {}'.format(e))
+
+@cli.command(help="Merges the export folders of the shards and checks every ticket is complete")
+@click.argument('sources', nargs=-1, type=click.Path(exists=True, file_okay=False))
+@click.option('-n', '--shards', type=click.IntRange(1), default=1, help="Number of shards to report the incomplete tickets of every shard")
+@click.pass_context
+def merge(ctx, sources, shards):
+    obj = ctx.obj['exporter']
+    EXPORT_FOLDER = Path(obj.get_config()['export_folder'])
+    EXPORT_FOLDER.mkdir(parents=True, exist_ok=True)
+    STORAGE = ctx.obj['storage']
+
+    # Index the tickets already in the destination first
+    count_tickets(EXPORT_FOLDER, None, STORAGE)
+    with TicketIndex(EXPORT_FOLDER) as index:
+        for source in sources:
+            if Path(source).resolve() == EXPORT_FOLDER.resolve():
+                continue
+            merged = merge_export(source, EXPORT_FOLDER, STORAGE, index)
+            click.echo('{} tickets merged from {}'.format(merged, click.format_filename(source)))
+
+    tickets = Counter()
+    incomplete = Counter()
+    total = count_tickets(EXPORT_FOLDER, None, STORAGE)
+    with click.progressbar(iter_tickets(EXPORT_FOLDER, None), length=total, label='Checking tickets') as bar:
+        for ticket_file, ticket_obj in bar:
+            shard = shard_of(ticket_obj['id'], shards)
+            tickets[shard] += 1
+            missing = check_ticket(ticket_file, ticket_obj, STORAGE)
+            if missing:
+                incomplete[shard] += 1
+                logger.info('Ticket {} misses {}'.format(ticket_obj['id'], ', '.join(missing)))
+
+    for shard in range(1, shards + 1):
+        click.echo('Shard {}/{}: {} tickets, {} incomplete'.format(shard, shards, tickets[shard], incomplete[shard]))
+    if sum(incomplete.values()):
+        click.secho('{} incomplete tickets, run the exports of their shards again'.format(sum(incomplete.values())), fg='red')
+        ctx.exit(1)
+
+
+def echo_problems(counts):
+    for (kind, problem), count in sorted(counts.items()):
+        click.echo('{} {}: {}'.format(kind, problem, count))
+
+@cli.command(help="Checks the tickets stored and writes a repair manifest of what is broken")
+@click.option('-m', '--manifest', type=click.Path(dir_okay=False), help="Repair manifest to write, repair.jsonl in the export folder by default")
+@click.pass_context
+def verify(ctx, manifest):
+    """
+    Every ticket, replies and comments document must be stored and parse,
+    and every attachment must be on disk with the size the API reported.
+    Tickets are checked in parallel by `download_threads` processes.
+    """
+    from beedumper.verify import MANIFEST_FILE, Manifest, verify_ticket
+
+    obj = ctx.obj['exporter']
+    config = obj.get_config()
+    EXPORT_FOLDER = Path(config['export_folder'])
+    STORAGE = ctx.obj['storage']
+    manifest = Path(manifest) if manifest else EXPORT_FOLDER.joinpath(MANIFEST_FILE)
+
+    if index_exists(EXPORT_FOLDER):
+        total = count_tickets(EXPORT_FOLDER, None, STORAGE)
+        folders = (ticket_file.parent for ticket_file, ticket_obj in iter_tickets(EXPORT_FOLDER, None))
+    else:
+        # Indexing would need every ticket to parse, list the folders instead
+        folders = list(STORAGE.ticket_folders(EXPORT_FOLDER))
+        total = len(folders)
+
+    def check(folder):
+        return verify_ticket(folder, STORAGE)
+
+    with serializer.atomic_writer(manifest) as writer:
+        problems = Manifest(writer)
+        run_pool(config, check, folders, total, problems)
+
+    echo_problems(problems.counts)
+    if len(problems):
+        click.secho('{} problems in {} of {} tickets, written to {}. Run repair to fix them'.format(
+            len(problems), problems.broken, problems.tickets, click.format_filename(str(manifest))), fg='red')
+        ctx.exit(1)
+    click.echo('{} tickets verified, no problems found'.format(problems.tickets))
+
+@cli.command(help="Fetches again only what verify found broken")
+@click.option('-m', '--manifest', type=click.Path(dir_okay=False), help="Repair manifest written by verify, repair.jsonl in the export folder by default")
+@click.pass_context
+def repair(ctx, manifest):
+    """
+    The manifest is written again with the problems left, so repair can run
+    until it succeeds.
+    """
+    from beedumper.export import make_session
+    from beedumper.verify import MANIFEST_FILE, read_manifest, verify_ticket
+
+    obj = ctx.obj['exporter']
+    config = obj.get_config()
+    EXPORT_FOLDER = Path(config['export_folder'])
+    STORAGE = ctx.obj['storage']
+    manifest = Path(manifest) if manifest else EXPORT_FOLDER.joinpath(MANIFEST_FILE)
+    if not manifest.exists():
+        raise ClickException('There is no repair manifest, run the verify command first')
+
+    tickets = read_manifest(manifest)
+    store = BlobStore(EXPORT_FOLDER) if config.get('attachments_store') else None
+    # The attachments don't get the JSON headers and params of the API session
+    session = make_session(config)
+    before = sum(len(problems) for problems in tickets.values())
+    left = Counter()
+
+    with TicketIndex(EXPORT_FOLDER) as index, \
+         serializer.atomic_writer(manifest) as writer, \
+         click.progressbar(sorted(tickets.items()), label='Repairing tickets') as bar:
+        for id, problems in bar:
+            folder = ticket_folder(EXPORT_FOLDER, id)
+            try:
+                repair_ticket(obj, folder, problems, STORAGE, index, store, session)
+            except Exception as e:
+                logger.error('Error when repairing ticket {}\r\n{}'.format(id, e))
+            for problem in verify_ticket(folder, STORAGE):
+                left[(problem['kind'], problem['problem'])] += 1
+                writer.write(serializer.dumps(problem) + b'\n')
+            index.commit()
+
+    click.echo('{} problems repaired in {} tickets'.format(max(0, before - sum(left.values())), len(tickets)))
+    if left:
+        echo_problems(left)
+        click.secho('{} problems left in {}, run repair again'.format(
+            sum(left.values()), click.format_filename(str(manifest))), fg='red')
+        ctx.exit(1)
 
 @cli.command(help="Exports all replies from the tickets stored")
 @click.option('-s', '--since-date', callback=validate_date, default='2000-01-01', help="Date since you want to export data in ISO format, example: 2017-11-28")
-@click.option('-f', '--force', is_flag=True, help="Don't skip downloaded files")
+@click.option('-f', '--force', is_flag=True, help="Don't skip downloaded files, unless the ticket did not change")
+@click.option('-e', '--engine', type=click.Choice(['async', 'pool']), default='async', help="Download with asyncio or with a pool of processes")
+@click.option('--shard', callback=validate_shard, help="Only process the tickets of the shard i of N, like 1/4")
 @click.pass_context
-def export_replies(ctx, since_date, force):
+def export_replies(ctx, since_date, force, engine, shard):
     obj = ctx.obj['exporter']
 
-    EXPORT_FOLDER = Path(obj.get_config()['export_folder'])
-    PROCS = obj.get_config()['download_threads']
+    config = obj.get_config()
+    EXPORT_FOLDER = Path(config['export_folder'])
+    STORAGE = ctx.obj['storage']
 
-    # Get the current tickets
-    tickets = list(EXPORT_FOLDER.joinpath('tickets').glob('**/ticket.json'))
+    EXPORT_FOLDER.mkdir(parents=True, exist_ok=True)
 
-    def save(ticket):
-        return save_replies(obj, ticket, since_date, force)
+    # Stream the current tickets
+    total = count_tickets(EXPORT_FOLDER, since_date, STORAGE, shard)
+    tickets = iter_tickets(EXPORT_FOLDER, since_date, config.get('change_detection', True), shard)
+    results = Results()
+
+    with TicketIndex(EXPORT_FOLDER) as index:
+        try:
+            if engine == 'async':
+                async def save(exporter, ticket):
+                    ticket_file, ticket_obj = ticket
+                    return await async_save_replies(exporter, ticket_file, since_date, force, ticket_obj=ticket_obj, storage=STORAGE)
+
+                click.echo('Starting the replies async download...')
+                run_async(config, save, tickets, total, results, record_synced(index, 'replies'))
+            else:
+                def save(ticket):
+                    ticket_file, ticket_obj = ticket
+                    return save_replies(obj, ticket_file, since_date, force, ticket_obj=ticket_obj, storage=STORAGE)
 
-    with Pool(PROCS) as p:
-        click.echo('Starting the replies parallel download...')
-        results = p.map(save, tickets)
-    writes = results.count(RESULTS_DOWNLOAD)
-    processed = results.count(RESULTS_SKIPPED) + writes
-    total = results.count(RESULTS_OLD) + processed
-    click.echo('Wrote {} out of {} checked replies from {} processed tickets'.format(writes, processed, total))
+                click.echo('Starting the replies parallel download...')
+                run_pool(config, save, tickets, total, results, record_synced(index, 'replies'))
+        finally:
+            results.echo('replies')
 
 
 @cli.command(help="Exports all comments from the tickets stored")
 @click.option('-s', '--since-date', callback=validate_date, default='2000-01-01', help="Date since you want to export data in ISO format, example: 2017-11-28")
-@click.option('-f', '--force', is_flag=True, help="Don't skip downloaded files")
+@click.option('-f', '--force', is_flag=True, help="Don't skip downloaded files, unless the ticket did not change")
+@click.option('-e', '--engine', type=click.Choice(['async', 'pool']), default='async', help="Download with asyncio or with a pool of processes")
+@click.option('--shard', callback=validate_shard, help="Only process the tickets of the shard i of N, like 1/4")
 @click.pass_context
-def export_comments(ctx, since_date, force):
+def export_comments(ctx, since_date, force, engine, shard):
     obj = ctx.obj['exporter']
 
-    EXPORT_FOLDER = Path(obj.get_config()['export_folder'])
-    PROCS = obj.get_config()['download_threads']
+    config = obj.get_config()
+    EXPORT_FOLDER = Path(config['export_folder'])
+    STORAGE = ctx.obj['storage']
 
-    # Get the current tickets
-    tickets = list(EXPORT_FOLDER.joinpath('tickets').glob('**/ticket.json'))
+    EXPORT_FOLDER.mkdir(parents=True, exist_ok=True)
 
-    def save(ticket):
-        return save_comments(obj, ticket, since_date, force)
+    # Stream the current tickets
+    total = count_tickets(EXPORT_FOLDER, since_date, STORAGE, shard)
+    tickets = iter_tickets(EXPORT_FOLDER, since_date, config.get('change_detection', True), shard)
+    results = Results()
 
-    with Pool(PROCS) as p:
-        click.echo('Starting the comments parallel download...')
-        results = p.map(save, tickets)
+    with TicketIndex(EXPORT_FOLDER) as index:
+        try:
+            if engine == 'async':
+                async def save(exporter, ticket):
+                    ticket_file, ticket_obj = ticket
+                    return await async_save_comments(exporter, ticket_file, since_date, force, ticket_obj=ticket_obj, storage=STORAGE)
 
-    writes = results.count(RESULTS_DOWNLOAD)
-    processed = results.count(RESULTS_SKIPPED) + writes
-    total = results.count(RESULTS_OLD) + processed
-    click.echo('Wrote {} out of {} checked comments from {} processed tickets'.format(writes, processed, total))
+                click.echo('Starting the comments async download...')
+                run_async(config, save, tickets, total, results, record_synced(index, 'comments'))
+            else:
+                def save(ticket):
+                    ticket_file, ticket_obj = ticket
+                    return save_comments(obj, ticket_file, since_date, force, ticket_obj=ticket_obj, storage=STORAGE)
+
+                click.echo('Starting the comments parallel download...')
+                run_pool(config, save, tickets, total, results, record_synced(index, 'comments'))
+        finally:
+            results.echo('comments')
 
 @cli.command(help="Exports all attachments from the tickets stored")
 @click.option('-s', '--since-date', callback=validate_date, default='2000-01-01', help="Date since you want to export data in ISO format, example: 2017-11-28")
 @click.option('-f', '--force', is_flag=True, help="Don't skip downloaded files")
+@click.option('-e', '--engine', type=click.Choice(['async', 'pool']), default='async', help="Download with asyncio or with a pool of processes")
+@click.option('--shard', callback=validate_shard, help="Only process the tickets of the shard i of N, like 1/4")
 @click.pass_context
-def export_attachments(ctx, force, since_date):
+def export_attachments(ctx, force, since_date, engine, shard):
     obj = ctx.obj['exporter']
     config = obj.get_config()
     EXPORT_FOLDER = Path(config['export_folder'])
-    PROCS = config['download_threads']
+    STORAGE = ctx.obj['storage']
     TOKEN = config['token']
     TIMEOUT = config['timeout']
+    STORE = BlobStore(EXPORT_FOLDER) if config.get('attachments_store') else None
 
-    # Get the current tickets
-    logger.debug('Getting the list of ticket files')
-    tickets = list(EXPORT_FOLDER.joinpath('tickets').glob('**/ticket.json'))
-
-    # Enrich the function with config data
-    def save(ticket):
-        return save_attachments(TOKEN, TIMEOUT, ticket, since_date, force)
+    # Stream the current tickets
+    total = count_tickets(EXPORT_FOLDER, since_date, STORAGE, shard)
+    tickets = iter_tickets(EXPORT_FOLDER, since_date, shard=shard)
+    results = Results()
 
-    with Pool(PROCS) as p:
-        click.echo('Starting the download...')
-        results = p.map(save, tickets)
+    try:
+        if engine == 'async':
+            async def save(exporter, ticket):
+                ticket_file, ticket_obj = ticket
+                return await async_save_attachments(exporter, ticket_file, since_date, force,
+                    ticket_obj=ticket_obj, store=STORE, storage=STORAGE)
+
+            click.echo('Starting the async download...')
+            run_async(config, save, tickets, total, results)
+        else:
+            # Enrich the function with config data
+            def save(ticket):
+                ticket_file, ticket_obj = ticket
+                return save_attachments(TOKEN, TIMEOUT, ticket_file, since_date, force,
+                    ticket_obj=ticket_obj, store=STORE, session=get_worker_session(config), storage=STORAGE,
+                    limiter=get_worker_limiter(config))
 
-    written = sum(map(lambda r: r.downloaded, results))
-    skipped = sum(map(lambda r: r.skipped, results))
-    click.echo('{} attachments written and {} skipped'.format(written, skipped))
+            click.echo('Starting the download...')
+            run_pool(config, save, tickets, total, results)
+    finally:
+        results.echo('attachments')
 
 
 @cli.command(help="Export all metadata")
 @click.option('-f', '--force', is_flag=True, help="Don't skip downloaded files")
 @click.pass_context
 def all_metadata(ctx, force):
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from beedumper.export import METADATA
+
     click.secho('# Exporting account metadata',fg='green')
-    ctx.invoke(labels)
-    ctx.invoke(snippets)
-    ctx.invoke(teams)
-    ctx.invoke(users)
+    obj = ctx.obj['exporter']
+    failed = False
+    # Every endpoint is an independent request, fetch them all at once
+    with ThreadPoolExecutor(len(METADATA)) as executor:
+        futures = dict((executor.submit(export_metadata, obj, name), name) for name in METADATA)
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                total, metadata_file = future.result()
+                click.echo('{} {} exported to {}'.format(total, name, click.format_filename(str(metadata_file))))
+            except Exception as e:
+                click.secho('{}: {}'.format(name, e), fg='red')
+                failed = True
+    if failed:
+        ctx.abort()
 
 @cli.command(help="Export all ticket info: tickets, replies, comments and attachments")
 @click.option('-s', '--since-date', callback=validate_date, default='2000-01-01', help="Date since you want to export data in ISO format, example: 2017-11-28")
+@click.option('-p', '--pipeline', is_flag=True, help="Stream every ticket page to the replies, comments and attachments downloads in a single pass")
+@click.option('-i', '--incremental', is_flag=True, help="Sync only what changed since the last incremental run, implies --pipeline")
+@click.option('--shard', callback=validate_shard, help="Only export the replies, comments and attachments of the shard i of N, like 1/4")
 @click.pass_context
-def all_tickets(ctx, since_date):
+def all_tickets(ctx, since_date, pipeline, incremental, shard):
+    from beedumper.state import SyncState
+
+    obj = ctx.obj['exporter']
+
+    if incremental:
+        EXPORT_FOLDER = Path(obj.get_config()['export_folder'])
+        EXPORT_FOLDER.mkdir(parents=True, exist_ok=True)
+        with SyncState(EXPORT_FOLDER) as state:
+            watermark = state.get_watermark()
+            if watermark is not None:
+                since_date = datetime.fromtimestamp(watermark, timezone.utc)
+            click.secho('# Syncing tickets changed since {}'.format(since_date.isoformat()),fg='green')
+            started = time.time()
+            results = run_pipeline(obj, since_date, False, False, False, state=state, storage=ctx.obj['storage'], shard=shard)
+            state.set_watermark(started)
+        echo_pipeline_results(results)
+        return
+
+    if pipeline:
+        click.secho('# Exporting tickets, replies, comments and attachments',fg='green')
+        results = run_pipeline(obj, since_date, True, True, False, storage=ctx.obj['storage'], shard=shard)
+        echo_pipeline_results(results)
+        return
+
     click.secho('# Exporting tickets',fg='green')
     ctx.invoke(export_tickets, since_date=since_date)
     click.secho('# Exporting replies',fg='green')
-    ctx.invoke(export_replies, since_date=since_date, force=True)
+    ctx.invoke(export_replies, since_date=since_date, force=True, shard=shard)
     click.secho('# Exporting comments',fg='green')
-    ctx.invoke(export_comments, since_date=since_date, force=True)
+    ctx.invoke(export_comments, since_date=since_date, force=True, shard=shard)
     click.secho('# Exporting attachments',fg='green')
-    ctx.invoke(export_attachments, since_date=since_date, force=False)
+    ctx.invoke(export_attachments, since_date=since_date, force=False, shard=shard)
 
 
 @cli.command(help="Export all account info, both metadata and tickets")
 @click.option('-s', '--since-date', callback=validate_date, default='2000-01-01', help="Date since you want to export data in ISO format, example: 2017-11-28")
+@click.option('-p', '--pipeline', is_flag=True, help="Stream every ticket page to the replies, comments and attachments downloads in a single pass")
+@click.option('-i', '--incremental', is_flag=True, help="Sync only what changed since the last incremental run, implies --pipeline")
+@click.option('--shard', callback=validate_shard, help="Only export the replies, comments and attachments of the shard i of N, like 1/4")
 @click.pass_context
-def all(ctx, since_date):
+def all(ctx, since_date, pipeline, incremental, shard):
     ctx.invoke(all_metadata)
-    ctx.invoke(all_tickets, since_date=since_date)
\ No newline at end of file
+    ctx.invoke(all_tickets, since_date=since_date, pipeline=pipeline, incremental=incremental, shard=shard)
@@ -0,0 +1,119 @@
+import hashlib
+import os
+import shutil
+from pathlib import Path
+
+
+CHUNK_SIZE = 64 * 1024
+STORE_FOLDER = 'blobs'
+
+
+class BlobStore(object):
+    """
+    Content addressed store of attachments, every file is stored once under
+    its sha256 and hard linked (or copied if the filesystem can't) into the
+    ticket folders
+    """
+    def __init__(self, export_folder):
+        self.folder = Path(export_folder).joinpath(STORE_FOLDER)
+
+    def add(self, source, digest, destination):
+        blob = self.folder.joinpath(digest[:2], digest)
+        if blob.exists():
+            source.unlink()
+        else:
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(str(source), str(blob))
+
+        if destination.exists():
+            destination.unlink()
+        try:
+            os.link(str(blob), str(destination))
+        except OSError:
+            shutil.copyfile(str(blob), str(destination))
+
+
+def partial_file(destination):
+    return destination.with_name(destination.name + '.part')
+
+def resume_state(part, store):
+    """
+    Offset to resume from and the hash of the partial content
+    """
+    digest = hashlib.sha256()
+    if not part.exists():
+        return 0, digest
+
+    offset = part.stat().st_size
+    if store is not None:
+        with part.open('rb') as reader:
+            for chunk in iter(lambda: reader.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+    return offset, digest
+
+def finish(part, destination, digest, store):
+    if store is not None:
+        store.add(part, digest.hexdigest(), destination)
+    else:
+        os.replace(str(part), str(destination))
+
+def download_file(url, destination, timeout=None, store=None, session=None, params=None):
+    """
+    Streams the url into a partial file next to the destination, resuming
+    it with a Range request if a previous download was interrupted, and
+    renames it when complete. Returns the number of bytes downloaded.
+    """
+    if session is None:
+        import requests
+        session = requests
+
+    part = partial_file(destination)
+    offset, digest = resume_state(part, store)
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+
+    with session.get(url, params=params, headers=headers, timeout=timeout, stream=True) as r:
+        if r.status_code == 416:
+            # The partial file is not valid anymore, start again
+            part.unlink()
+            return download_file(url, destination, timeout, store, session, params)
+        r.raise_for_status()
+        if r.status_code != 206:
+            offset, digest = 0, hashlib.sha256()
+
+        size = 0
+        with part.open('ab' if offset else 'wb') as writer:
+            for chunk in r.iter_content(CHUNK_SIZE):
+                writer.write(chunk)
+                size += len(chunk)
+                if store is not None:
+                    digest.update(chunk)
+
+    finish(part, destination, digest, store)
+    return size
+
+async def async_download_file(client, url, destination, store=None, params=None):
+    """
+    Same as download_file with an httpx.AsyncClient
+    """
+    part = partial_file(destination)
+    offset, digest = resume_state(part, store)
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+
+    async with client.stream('GET', url, params=params, headers=headers) as r:
+        if r.status_code == 416:
+            part.unlink()
+            return await async_download_file(client, url, destination, store, params)
+        r.raise_for_status()
+        if r.status_code != 206:
+            offset, digest = 0, hashlib.sha256()
+
+        size = 0
+        with part.open('ab' if offset else 'wb') as writer:
+            async for chunk in r.aiter_bytes(CHUNK_SIZE):
+                writer.write(chunk)
+                size += len(chunk)
+                if store is not None:
+                    digest.update(chunk)
+
+    finish(part, destination, digest, store)
+    return size
@@ -1,72 +1,366 @@
 import requests
+import logging
+import time
 from collections import namedtuple
+from itertools import islice
 from pathlib import Path
-import json
+
+from beedumper import serializer
+from beedumper.download import download_file, async_download_file
+from beedumper.metrics import METRICS, endpoint_name
+from beedumper.paging import PageSizer, TicketPage, split
+from beedumper.ratelimit import RateLimiter, AsyncRateLimiter, THROTTLE_STATUS, retry_after
+
+logger = logging.getLogger('beedumper')
+
+HEADERS = { 'Accept' : 'application/json', 'Cache-Control' : 'no-cache', 'Content-Type': 'application/json'}
+
+# A ticket with its replies and comments, yielded by iter_ticket_bundles
+TicketBundle = namedtuple('TicketBundle', ['ticket', 'replies', 'comments'])
+
+# Metadata exports: endpoint, key of the items in the response and params
+METADATA = {
+    'users': ('/users', 'users', {'with_invited': True}),
+    'labels': ('/labels', 'labels', {}),
+    'teams': ('/teams', 'teams', {}),
+    'snippets': ('/snippets', 'snippets', {}),
+    'emails': ('/emails', 'forwarding_addresses', {}),
+}
+
+def make_session(config):
+    """
+    requests Session with a connection pool sized from the config
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=config.get('pool_size', 10))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if not config.get('keep_alive', True):
+        session.headers['Connection'] = 'close'
+    return session
+
+def session_stats(session):
+    """
+    Requests and connections made per host by a requests Session
+    """
+    stats = {}
+    # The same adapter is usually mounted for http and https
+    adapters = dict((id(adapter), adapter) for adapter in session.adapters.values())
+    for adapter in adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            host = stats.setdefault(key.key_host, {'requests': 0, 'connections': 0})
+            host['requests'] += pool.num_requests
+            host['connections'] += pool.num_connections
+    return stats
+
+def since_param(since_date):
+    """
+    `since` of the ticket listing from a date or an ISO string
+    """
+    if since_date is None or isinstance(since_date, str):
+        return since_date
+    return since_date.isoformat()
+
+def thread_map(func, items, concurrency):
+    """
+    Runs the function over the items in a pool of threads keeping at most
+    `concurrency` calls in flight, yielding the results as they complete.
+    Items are only taken as calls complete, so a slow consumer holds back
+    the producer.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = set(executor.submit(func, item) for item in islice(items, concurrency))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for item in islice(items, 1):
+                    pending.add(executor.submit(func, item))
+                yield future.result()
+
+def download_with_retries(limiter, url, destination, timeout=None, store=None, session=None, params=None):
+    """
+    download_file through the rate limiter, retrying with backoff connection
+    errors, throttling and server errors. A retried download resumes from
+    the partial file.
+    """
+    attempt = 0
+    while True:
+        started = limiter.acquire()
+        try:
+            size = download_file(url, destination, timeout, store, session, params)
+            limiter.success()
+            METRICS.observe_request('/attachments', time.time() - started, size, 200)
+            return size
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            status, headers, error = None, {}, e
+            METRICS.observe_request('/attachments', time.time() - started, 0, 'error')
+        except requests.HTTPError as e:
+            status, headers, error = e.response.status_code, e.response.headers, e
+            METRICS.observe_request('/attachments', time.time() - started, 0, status)
+        finally:
+            limiter.release()
+
+        if status in THROTTLE_STATUS:
+            METRICS.inc('throttled')
+            limiter.throttle(started, retry_after(headers))
+
+        delay = limiter.delay(attempt, status, headers)
+        if delay is None:
+            METRICS.inc('failures', endpoint='/attachments')
+            raise error
+
+        METRICS.inc('retries', endpoint='/attachments')
+        logger.info('Retrying {} in {:.1f} seconds'.format(url, delay))
+        time.sleep(delay)
+        attempt += 1
 
 class Exporter(object):
     def __init__(self, config):
         self.config = config
-        self.session = requests.Session()
-        self.session.headers.update({ 'Accept' : 'application/json', 'Cache-Control' : 'no-cache', 'Content-Type': 'application/json'})
+        self.session = make_session(config)
+        self.session.headers.update(HEADERS)
         self.session.params.update({ 'auth_token' : config['token'], 'per_page' : config['per_page']})
         self.url = config['url']
+        self.limiter = RateLimiter(config, config.get('pool_size', 10))
     
     def get_config(self):
         return self.config
 
+    def connection_stats(self):
+        return session_stats(self.session)
+
+    def get_response(self, endpoint, params = {}, stream=False, retry_timeouts=True):
+        """
+        GET the endpoint through the rate limiter, retrying with backoff
+        connection errors, throttling and server errors. With `stream` the
+        body is left to be read from the response.
+        """
+        attempt = 0
+        while True:
+            started = self.limiter.acquire()
+            try:
+                r = self.session.get(url=self.url + endpoint, params=params, timeout=self.config.get('timeout'),
+                                     stream=stream)
+                error = None
+                size = int(r.headers.get('Content-Length', 0)) if stream and r.status_code == 200 else len(r.content)
+                METRICS.observe_request(endpoint, time.time() - started, size, r.status_code)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                r, error = None, e
+                METRICS.observe_request(endpoint, time.time() - started, 0, 'error')
+                if isinstance(e, requests.Timeout) and not retry_timeouts:
+                    raise
+            finally:
+                self.limiter.release()
+
+            if r is not None and r.status_code == 200:
+                self.limiter.success()
+                return r
+
+            status = r.status_code if r is not None else None
+            headers = r.headers if r is not None else {}
+            if status in THROTTLE_STATUS:
+                METRICS.inc('throttled')
+                self.limiter.throttle(started, retry_after(headers))
+
+            delay = self.limiter.delay(attempt, status, headers)
+            if delay is None:
+                METRICS.inc('failures', endpoint=endpoint_name(endpoint))
+                if error is not None:
+                    raise error
+                raise Exception('Status code: {}\r\nError: {}'.format(r.status_code,r.text))
+
+            METRICS.inc('retries', endpoint=endpoint_name(endpoint))
+            logger.info('Retrying {} in {:.1f} seconds'.format(endpoint, delay))
+            time.sleep(delay)
+            attempt += 1
+
     def get_data(self, endpoint, params = {}):
-        r = self.session.get(url=self.url + endpoint, params=params)
-        if r.status_code == 200:
-            return r.json()
-        else:
-            raise Exception('Status code: {}\r\nError: {}'.format(r.status_code,r.text))
+        return serializer.loads(self.get_response(endpoint, params).content)
     
+    def iter_metadata(self, name):
+        """
+        Yields the pages of items of a metadata endpoint, following
+        `total_pages` when the API paginates it
+        """
+        endpoint, key, params = METADATA[name]
+        page = 1
+        while True:
+            data = self.get_data(endpoint, params=dict(params, page=page) if page > 1 else params)
+            yield data[key]
+            if page >= data.get('total_pages', 1):
+                return
+            page += 1
+
+    def get_metadata(self, name):
+        return [item for page in self.iter_metadata(name) for item in page]
+
     def get_users(self):
-        data = self.get_data('/users', params={'with_invited' : True})
-        return data['users']
+        return self.get_metadata('users')
 
     def get_labels(self):
-        data = self.get_data('/labels')
-        return data['labels']
+        return self.get_metadata('labels')
 
     def get_teams(self):
-        data = self.get_data('/teams')
-        return data['teams']
+        return self.get_metadata('teams')
 
     def get_snippets(self):
-        data = self.get_data('/snippets')
-        return data['snippets']
+        return self.get_metadata('snippets')
     
     def get_emails(self):
-        data = self.get_data('/emails')
-        return data['forwarding_addresses']
+        return self.get_metadata('emails')
     
-    def get_tickets(self, per_page=100, since_date=None):
-        tickets = namedtuple('tickets',['page','total_pages','data'])
-        more_pages = True
-        page = 0
-        while more_pages:
-            page += 1
+    def fetch_tickets(self, offset, size, since_date=None, stream=False, retry_timeouts=True, skip=0):
+        """
+        TicketPage of `size` tickets from `offset`, a multiple of `size`
+        """
+        params = {
+            'per_page': size,
+            'page'    : offset // size + 1,
+            'archived': True
+        }
+
+        if since_date != None :
+            params['since'] = since_date
+
+        r = self.get_response('/tickets', params=params, stream=stream, retry_timeouts=retry_timeouts)
+        return TicketPage(offset, size, r, stream, skip)
+
+    def get_tickets(self, per_page=None, since_date=None, prefetch=None, ordered=True):
+        """
+        Yields the pages of tickets, see TicketPage, each one must be
+        consumed before asking for the next. Once the first page reports
+        the total the rest are fetched in parallel keeping up to `prefetch`
+        pages in flight. Pages are yielded in the order of the listing, or
+        as soon as they respond with `ordered=False`.
+
+        The page size starts at `per_page` and adapts to how fast and big
+        the pages are, see PageSizer. Pages timing out or failing half way
+        are fetched again in smaller pages from the first ticket not yielded.
+        """
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+        sizer = PageSizer(self.config, per_page)
+        stream = serializer.streaming()
+        if prefetch is None:
+            prefetch = self.config.get('prefetch_pages', 4)
+
+        # Ranges of tickets to fetch again first, sorted: offset, size, skip and attempt
+        retry = [(0, sizer.size, 0, 0)]
+        planned = sizer.size
+        total = None
+        # Size of the pages since the listing started again, see PageSizer.limit
+        restarted = None
+
+        def plan():
+            nonlocal planned
+            if retry:
+                return retry.pop(0)
+            # Nothing else is known until the first page tells the total
+            if total is None or planned >= total:
+                return None
+            size = sizer.size
+            while planned % size:
+                size //= 2
+            planned += size
+            return planned - size, size, 0, 0
+
+        def fetch(offset, size, skip):
+            # The smallest pages retry their timeouts as any other request
+            return self.fetch_tickets(offset, size, since_date, stream, size <= sizer.minimum, skip)
+
+        def fetch_again(offset, size, attempt, error, done=0):
+            if size <= sizer.minimum and (isinstance(error, requests.Timeout) or attempt >= self.limiter.retries):
+                raise error
+            METRICS.inc('page_retries')
+            logger.info('Fetching tickets {} to {} again: {}'.format(offset, offset + size, error))
+            sizer.shrink(size)
+            pieces = split(offset, size, sizer.size, done)
+            if not pieces and total is None:
+                # Every ticket was decoded but not the total, ask for it again
+                pieces = [(offset + size - sizer.size, sizer.size, sizer.size)]
+            retry.extend((start, piece, skip, attempt + 1) for start, piece, skip in pieces)
+            retry.sort()
+
+        def deliver(ticket_range, page):
+            nonlocal planned, total, restarted
+            offset, size, skip, attempt = ticket_range
+            yield page
+            page.finish()
+
+            if page.capped:
+                per_page = page.values['per_page']
+                if restarted is not None and size != restarted:
+                    # Asked for before starting again, the new pages cover it
+                    return
+                if sizer.limit(per_page):
+                    # No page could be split that small: every page asked for
+                    # was capped, list again with the size of the API
+                    logger.info('Listing the tickets again in pages of {}'.format(per_page))
+                    restarted = per_page
+                    retry[:] = []
+                    planned = 0
+                    total = page.total
+                else:
+                    fetch_again(offset, size, attempt, Exception('{} tickets per page at most'.format(per_page)), skip)
+            elif page.failed is not None:
+                fetch_again(offset, size, attempt, page.failed, max(skip, page.decoded))
+            else:
+                sizer.observe(size, page.seconds, page.length)
+                if total is None:
+                    total = page.total
 
-            params = {
-                'per_page': per_page,
-                'page'    : page,
-                'archived': True
-            }
-
-            if since_date != None :
-                params['since'] = since_date
-
-            results = self.get_data('/tickets', params=params)
-            
-            if results['current_page'] >= results['total_pages']:
-                more_pages = False
-            
-            yield tickets( 
-                results['current_page'], 
-                results['total_pages'],
-                results['tickets']
-            )
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            pending = {}
+            # Pages that arrived before the ones preceding them, by offset and size
+            ready = {}
+
+            def submit():
+                ticket_range = plan()
+                if ticket_range is not None:
+                    pending[executor.submit(fetch, *ticket_range[:3])] = ticket_range
+                return ticket_range
+
+            def first():
+                """
+                Offset and size of the first range not yielded yet
+                """
+                ranges = list(pending.values()) + retry + [ticket_range for ticket_range, page in ready.values()]
+                return min(ticket_range[:2] for ticket_range in ranges) if ranges else None
+
+            submit()
+            while pending or ready:
+                if ordered and first() in ready:
+                    yield from deliver(*ready.pop(first()))
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        ticket_range = pending.pop(future)
+                        try:
+                            page = future.result()
+                        except requests.Timeout as e:
+                            offset, size, skip, attempt = ticket_range
+                            fetch_again(offset, size, attempt, e, skip)
+                            continue
+                        if ordered:
+                            ready[ticket_range[:2]] = (ticket_range, page)
+                        else:
+                            yield from deliver(ticket_range, page)
+
+                # The pages held count against the prefetch, but the first
+                # range is always asked for so the pages held get yielded
+                while len(pending) + len(ready) < prefetch and submit() is not None:
+                    pass
+                if not pending and first() not in ready:
+                    submit()
+
+    def get_ticket(self, ticket_id):
+        data = self.get_data('/tickets/{}'.format(ticket_id))
+        return data['ticket']
 
     def get_replies(self, ticket_id):
         data = self.get_data('/tickets/{}/replies'.format(ticket_id))
@@ -75,4 +369,265 @@ class Exporter(object):
     def get_comments(self, ticket_id):
         data = self.get_data('/tickets/{}/comments'.format(ticket_id))
         return data['comments']
-    
+
+    def get_many(self, get, ids, concurrency=None, return_exceptions=False):
+        """
+        Yields (id, get(id)) for all the ids as they complete, with up to
+        `concurrency` requests in flight, the size of the connection pool
+        by default. With `return_exceptions` a failed id is yielded with
+        its exception instead of raising it.
+        """
+        def fetch(id):
+            try:
+                return id, get(id)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                return id, e
+
+        return thread_map(fetch, ids, concurrency or self.limiter.maximum)
+
+    def get_replies_many(self, ids, concurrency=None, return_exceptions=False):
+        return self.get_many(self.get_replies, ids, concurrency, return_exceptions)
+
+    def get_comments_many(self, ids, concurrency=None, return_exceptions=False):
+        return self.get_many(self.get_comments, ids, concurrency, return_exceptions)
+
+    def iter_tickets(self, since_date=None):
+        """
+        Yields the tickets of the listing as they are decoded
+        """
+        for page in self.get_tickets(since_date=since_param(since_date), ordered=False):
+            for ticket in page:
+                yield ticket
+
+    def iter_ticket_bundles(self, since_date=None, concurrency=None):
+        """
+        Yields a TicketBundle for every ticket active since the date, as
+        soon as its replies and comments are fetched, with up to
+        `concurrency` tickets in flight
+        """
+        def bundle(ticket):
+            return TicketBundle(ticket, self.get_replies(ticket['id']), self.get_comments(ticket['id']))
+
+        return thread_map(bundle, self.iter_tickets(since_date), concurrency or self.limiter.maximum)
+
+
+async def bounded_map(func, items, concurrency):
+    """
+    Runs the coroutine function over the items, an iterable or an async
+    iterable, keeping at most `concurrency` calls in flight, yielding the
+    results as they complete
+    """
+    import asyncio
+
+    if not hasattr(items, '__aiter__'):
+        items = iterate(items)
+
+    pending = set()
+    async for item in items:
+        if len(pending) >= concurrency:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        else:
+            # Don't hold the results while a slow source gets the next item
+            done = set(task for task in pending if task.done())
+            pending -= done
+        for task in done:
+            yield task.result()
+        pending.add(asyncio.ensure_future(func(item)))
+
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            yield task.result()
+
+
+async def iterate(items):
+    for item in items:
+        yield item
+
+
+class AsyncExporter(object):
+    """
+    asyncio version of the Exporter to be used as an async context manager,
+    a single client keeps up to `async_concurrency` requests in flight
+    """
+    def __init__(self, config):
+        self.config = config
+        self.url = config['url']
+        self.concurrency = config.get('async_concurrency', 100)
+        self.params = { 'auth_token' : config['token'], 'per_page' : config['per_page']}
+        self.client = None
+        self.limiter = None
+        self.stats = {}
+
+    async def __aenter__(self):
+        import httpx
+
+        config = self.config
+        self.limiter = AsyncRateLimiter(config, self.concurrency)
+        limits = httpx.Limits(
+            max_connections=config.get('pool_size', self.concurrency),
+            max_keepalive_connections=None if config.get('keep_alive', True) else 0,
+            keepalive_expiry=config.get('keepalive_expiry', 5))
+
+        http2 = config.get('http2', False)
+        if http2:
+            try:
+                import h2
+            except ImportError:
+                logger.warning('HTTP/2 needs the h2 package, using HTTP/1.1')
+                http2 = False
+
+        # The JSON headers go only with the API requests, not the downloads,
+        # and redirects are followed as requests does
+        self.client = httpx.AsyncClient(
+            follow_redirects=True,
+            timeout=config.get('timeout'),
+            limits=limits,
+            http2=http2,
+            event_hooks={'response': [self.track_connection]})
+        return self
+
+    async def __aexit__(self, *args):
+        await self.client.aclose()
+        self.client = None
+
+    def get_config(self):
+        return self.config
+
+    async def track_connection(self, response):
+        host = self.stats.setdefault(response.request.url.host, {'requests': 0, 'connections': set()})
+        host['requests'] += 1
+        stream = response.extensions.get('network_stream')
+        if stream is not None:
+            host['connections'].add(stream.get_extra_info('client_addr'))
+
+    def connection_stats(self):
+        return dict(
+            (host, {'requests': stats['requests'], 'connections': len(stats['connections'])})
+            for host, stats in self.stats.items())
+
+    async def request(self, description, send, endpoint):
+        """
+        Awaits the coroutine function through the rate limiter, retrying
+        with backoff transport errors, throttling and server errors
+        """
+        import asyncio
+        import httpx
+
+        endpoint = endpoint_name(endpoint)
+        attempt = 0
+        while True:
+            started = await self.limiter.acquire()
+            try:
+                result, size = await send()
+                self.limiter.success()
+                METRICS.observe_request(endpoint, time.time() - started, size, 200)
+                return result
+            except httpx.TransportError as e:
+                status, headers, error = None, {}, e
+                METRICS.observe_request(endpoint, time.time() - started, 0, 'error')
+            except httpx.HTTPStatusError as e:
+                status, headers, error = e.response.status_code, e.response.headers, e
+                METRICS.observe_request(endpoint, time.time() - started, 0, status)
+            finally:
+                self.limiter.release()
+
+            if status in THROTTLE_STATUS:
+                METRICS.inc('throttled')
+                self.limiter.throttle(started, retry_after(headers))
+
+            delay = self.limiter.delay(attempt, status, headers)
+            if delay is None:
+                METRICS.inc('failures', endpoint=endpoint)
+                raise error
+
+            METRICS.inc('retries', endpoint=endpoint)
+            logger.info('Retrying {} in {:.1f} seconds'.format(description, delay))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def get_data(self, endpoint, params = {}):
+        import httpx
+
+        query = dict(self.params)
+        query.update(params)
+
+        async def send():
+            r = await self.client.get(self.url + endpoint, params=query, headers=HEADERS)
+            if r.status_code != 200:
+                raise httpx.HTTPStatusError(
+                    'Status code: {}\r\nError: {}'.format(r.status_code,r.text), request=r.request, response=r)
+            return serializer.loads(r.content), len(r.content)
+
+        return await self.request(endpoint, send, endpoint)
+
+    async def get_replies(self, ticket_id):
+        data = await self.get_data('/tickets/{}/replies'.format(ticket_id))
+        return data['replies']
+
+    async def get_comments(self, ticket_id):
+        data = await self.get_data('/tickets/{}/comments'.format(ticket_id))
+        return data['comments']
+
+    async def get_many(self, get, ids, concurrency=None, return_exceptions=False):
+        """
+        Same as Exporter.get_many with a coroutine function, `ids` can be
+        an async iterable too
+        """
+        async def fetch(id):
+            try:
+                return id, await get(id)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                return id, e
+
+        async for result in bounded_map(fetch, ids, concurrency or self.concurrency):
+            yield result
+
+    def get_replies_many(self, ids, concurrency=None, return_exceptions=False):
+        return self.get_many(self.get_replies, ids, concurrency, return_exceptions)
+
+    def get_comments_many(self, ids, concurrency=None, return_exceptions=False):
+        return self.get_many(self.get_comments, ids, concurrency, return_exceptions)
+
+    async def iter_tickets(self, since_date=None):
+        """
+        Yields the tickets of the listing, fetched and decoded by a
+        blocking Exporter off the loop
+        """
+        import asyncio
+
+        loop = asyncio.get_event_loop()
+        tickets = Exporter(self.config).iter_tickets(since_date)
+        while True:
+            ticket = await loop.run_in_executor(None, next, tickets, None)
+            if ticket is None:
+                break
+            yield ticket
+
+    async def iter_ticket_bundles(self, since_date=None, concurrency=None):
+        """
+        Same as Exporter.iter_ticket_bundles, the replies and comments of
+        every ticket are fetched at the same time
+        """
+        import asyncio
+
+        async def bundle(ticket):
+            replies, comments = await asyncio.gather(
+                self.get_replies(ticket['id']), self.get_comments(ticket['id']))
+            return TicketBundle(ticket, replies, comments)
+
+        async for result in bounded_map(bundle, self.iter_tickets(since_date), concurrency or self.concurrency):
+            yield result
+
+    async def download(self, url, destination, store=None):
+        # A retried download resumes from the partial file
+        async def send():
+            size = await async_download_file(
+                self.client, url, destination, store, params={'auth_token': self.config['token']})
+            return size, size
+
+        return await self.request(url, send, '/attachments')
@@ -0,0 +1,141 @@
+import sqlite3
+from datetime import datetime, timezone
+from pathlib import Path
+
+from beedumper.state import activity_timestamp
+
+INDEX_FILE = 'index.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tickets (
+    id INTEGER PRIMARY KEY,
+    last_activity_at REAL NOT NULL,
+    attachments INTEGER NOT NULL,
+    folder TEXT NOT NULL,
+    fingerprint TEXT,
+    replies_fingerprint TEXT,
+    comments_fingerprint TEXT
+);
+CREATE INDEX IF NOT EXISTS tickets_activity ON tickets (last_activity_at);
+"""
+
+# Columns added after the first version of the index
+COLUMNS = ['fingerprint', 'replies_fingerprint', 'comments_fingerprint']
+SYNCED = ['replies', 'comments']
+
+def index_exists(export_folder):
+    return Path(export_folder).joinpath(INDEX_FILE).exists()
+
+def ticket_fingerprint(ticket):
+    """
+    Changes whenever the ticket gets activity, replies or comments
+    """
+    return '{}:{}:{}'.format(ticket.get('last_activity_at'), ticket.get('replies_count'), ticket.get('comments_count'))
+
+
+class TicketIndex(object):
+    """
+    Compact index of the tickets stored in the export folder so the
+    downstream exports don't need to walk the tree and parse every
+    ticket.json file.
+
+    It also keeps the fingerprint of every ticket when its replies and
+    comments were last saved, so unchanged tickets don't fetch them again.
+    """
+    def __init__(self, export_folder):
+        self.export_folder = Path(export_folder)
+        self.path = self.export_folder.joinpath(INDEX_FILE)
+        self.connection = sqlite3.connect(str(self.path), timeout=60)
+        self.connection.executescript(SCHEMA)
+        existing = [row[1] for row in self.connection.execute('PRAGMA table_info(tickets)')]
+        for column in COLUMNS:
+            if column not in existing:
+                self.connection.execute('ALTER TABLE tickets ADD COLUMN {} TEXT'.format(column))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def commit(self):
+        self.connection.commit()
+
+    def add(self, ticket, folder):
+        self.connection.execute(
+            """INSERT INTO tickets (id, last_activity_at, attachments, folder, fingerprint) VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT(id) DO UPDATE SET
+                   last_activity_at = excluded.last_activity_at,
+                   attachments = excluded.attachments,
+                   folder = excluded.folder,
+                   fingerprint = excluded.fingerprint""",
+            (int(ticket['id']),
+             activity_timestamp(ticket),
+             len(ticket['content']['attachments']),
+             str(Path(folder).relative_to(self.export_folder)),
+             ticket_fingerprint(ticket)))
+
+    def is_synced(self, ticket_id, resource):
+        """
+        Whether the resource was saved with the current fingerprint
+        """
+        row = self.connection.execute(
+            'SELECT fingerprint, {0}_fingerprint FROM tickets WHERE id = ?'.format(resource),
+            (int(ticket_id),)).fetchone()
+        return row is not None and row[0] is not None and row[0] == row[1]
+
+    def mark_synced(self, ticket_id, resource, fingerprint):
+        self.connection.execute(
+            'UPDATE tickets SET {0}_fingerprint = ? WHERE id = ?'.format(resource), (fingerprint, int(ticket_id)))
+
+    def __len__(self):
+        return self.connection.execute('SELECT count(*) FROM tickets').fetchone()[0]
+
+    def count(self, since_date=None, shard=None):
+        since = since_date.timestamp() if since_date is not None else float('-inf')
+        shard, shards = shard or (1, 1)
+        return self.connection.execute(
+            'SELECT count(*) FROM tickets WHERE last_activity_at > ? AND id % ? = ?',
+            (since, shards, shard - 1)).fetchone()[0]
+
+    def tickets(self, since_date=None, batch=1000, shard=None):
+        """
+        Yields (ticket_file, ticket_obj) for the tickets with activity after
+        the date. ticket_obj is a stub with the id and last activity, and an
+        empty list of attachments when the ticket has none, so callers only
+        need to read ticket.json for the tickets with attachments. The stub
+        also has the fingerprint of the ticket and the list of resources
+        saved with it under `synced`.
+
+        With a (shard, shards) tuple only the tickets whose id modulus the
+        number of shards matches the shard, numbered from 1, are yielded.
+
+        Rows are read in batches of ids so memory doesn't grow with the
+        number of tickets.
+        """
+        since = since_date.timestamp() if since_date is not None else float('-inf')
+        shard, shards = shard or (1, 1)
+        last_id = None
+        while True:
+            rows = self.connection.execute(
+                'SELECT id, last_activity_at, attachments, folder, fingerprint, '
+                'replies_fingerprint, comments_fingerprint FROM tickets '
+                'WHERE id > ? AND last_activity_at > ? AND id % ? = ? ORDER BY id LIMIT ?',
+                (last_id if last_id is not None else -1, since, shards, shard - 1, batch)).fetchall()
+            if not rows:
+                return
+            for id, last_activity_at, attachments, folder, fingerprint, *synced in rows:
+                ticket_obj = {
+                    'id': id,
+                    'last_activity_at': datetime.fromtimestamp(last_activity_at, timezone.utc).isoformat(),
+                    'fingerprint': fingerprint,
+                    'synced': [resource for resource, value in zip(SYNCED, synced) if fingerprint and value == fingerprint]
+                }
+                if attachments == 0:
+                    ticket_obj['content'] = {'attachments': []}
+                yield self.export_folder.joinpath(folder, 'ticket.json'), ticket_obj
+            last_id = rows[-1][0]
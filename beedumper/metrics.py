@@ -0,0 +1,160 @@
+"""
+Run time metrics of an export: latency histograms and counters per
+endpoint, retries, queue depths and worker utilization. They are dumped
+at the end of the run as JSON or as a Prometheus textfile.
+
+Metrics are kept per process so the workers of the `pool` engine don't
+report theirs.
+"""
+import json
+import os
+import re
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def endpoint_name(path):
+    """
+    Groups the endpoints of every ticket: /tickets/123/replies is
+    /tickets/:id/replies
+    """
+    return re.sub(r'/\d+', '/:id', path)
+
+
+class Histogram(object):
+    __slots__ = 'counts', 'sum', 'count',
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the quantile
+        """
+        target = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float('inf')
+        return 0.0
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.workers = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+            # Keep the peak of every gauge too
+            peak = ('{}_max'.format(name), key[1])
+            self.gauges[peak] = max(self.gauges.get(peak, value), value)
+
+    def get(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def observe_request(self, endpoint, seconds, size, status):
+        endpoint = endpoint_name(endpoint)
+        with self.lock:
+            histogram = self.histograms.get(endpoint)
+            if histogram is None:
+                histogram = self.histograms[endpoint] = Histogram()
+            histogram.observe(seconds)
+        self.inc('requests', endpoint=endpoint, status=str(status))
+        self.inc('bytes', size, endpoint=endpoint)
+
+    def add_workers(self, stage, workers):
+        self.workers[stage] = self.workers.get(stage, 0) + workers
+
+    def busy(self, stage, seconds):
+        self.inc('worker_busy_seconds', seconds, stage=stage)
+
+    def utilization(self):
+        elapsed = time.time() - self.started
+        return dict(
+            (stage, self.get('worker_busy_seconds', stage=stage) / (workers * elapsed))
+            for stage, workers in self.workers.items() if workers and elapsed)
+
+    def as_dict(self):
+        def flatten(values):
+            return [dict(labels, name=name, value=value) for (name, labels), value in sorted(values.items())]
+
+        return {
+            'elapsed_seconds': time.time() - self.started,
+            'counters': flatten(self.counters),
+            'gauges': flatten(self.gauges),
+            'latency': dict((endpoint, {
+                'count': histogram.count,
+                'mean': histogram.sum / histogram.count if histogram.count else 0,
+                'p50': histogram.quantile(0.5),
+                'p90': histogram.quantile(0.9),
+                'p99': histogram.quantile(0.99),
+                'buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'], histogram.counts)),
+            }) for endpoint, histogram in self.histograms.items()),
+            'worker_utilization': self.utilization(),
+        }
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+    def to_prometheus(self):
+        def labels_text(labels):
+            if not labels:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(key, value) for key, value in labels) + '}'
+
+        lines = ['beedumper_elapsed_seconds {}'.format(time.time() - self.started)]
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append('beedumper_{}_total{} {}'.format(name, labels_text(labels), value))
+        for (name, labels), value in sorted(self.gauges.items()):
+            lines.append('beedumper_{}{} {}'.format(name, labels_text(labels), value))
+        for endpoint, histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'], histogram.counts):
+                cumulative += count
+                lines.append('beedumper_request_seconds_bucket{{endpoint="{}",le="{}"}} {}'.format(endpoint, bound, cumulative))
+            lines.append('beedumper_request_seconds_sum{{endpoint="{}"}} {}'.format(endpoint, histogram.sum))
+            lines.append('beedumper_request_seconds_count{{endpoint="{}"}} {}'.format(endpoint, histogram.count))
+        for stage, value in sorted(self.utilization().items()):
+            lines.append('beedumper_worker_utilization{{stage="{}"}} {}'.format(stage, value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Prometheus textfile when the file ends with .prom, JSON otherwise
+        """
+        content = self.to_prometheus() if str(path).endswith('.prom') else self.to_json()
+        # Written aside and renamed so collectors never read half a file
+        temp = '{}.tmp'.format(path)
+        with open(temp, 'w') as writer:
+            writer.write(content)
+        os.replace(temp, str(path))
+
+
+# Metrics of the running process
+METRICS = Metrics()
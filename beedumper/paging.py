@@ -0,0 +1,186 @@
+"""
+Adaptive pagination of the ticket listing. The page size doubles while
+pages come back fast and small and halves on timeouts or big payloads,
+and with ijson installed every page is decoded ticket by ticket straight
+from the connection, so memory stays bounded whatever the size of the
+tickets.
+"""
+import logging
+
+import requests
+from urllib3.exceptions import HTTPError
+
+from beedumper import serializer
+from beedumper.metrics import METRICS
+
+logger = logging.getLogger('beedumper')
+
+# A page failing half way is fetched again in smaller pages
+STREAM_ERRORS = (requests.RequestException, HTTPError, ValueError)
+
+
+def split(offset, size, piece, done=0):
+    """
+    (offset, size, skip) of the pieces of `piece` tickets covering `size`
+    tickets from `offset` but the first `done` ones
+    """
+    return [(start, piece, max(0, offset + done - start))
+            for start in range(offset, offset + size, piece) if start + piece > offset + done]
+
+
+class PageSizer(object):
+    """
+    Page size of the ticket requests. Sizes are `min_per_page` times a
+    power of two up to `max_per_page`, so the offset of any page is a
+    multiple of every smaller size and a page can always be split in pages
+    of the current size.
+    """
+    def __init__(self, config, per_page=None):
+        if per_page is None:
+            per_page = config.get('per_page', 100)
+        if config.get('adaptive_paging', True):
+            self.minimum = max(1, config.get('min_per_page', 25))
+            self.maximum = max(self.minimum, config.get('max_per_page', 100))
+            self.maximum = self.fit(self.maximum)
+        else:
+            self.minimum = self.maximum = per_page
+        self.target = config.get('page_target_seconds', 2)
+        self.max_bytes = config.get('page_max_bytes', 4 * 1024 * 1024)
+        self.size = self.fit(per_page)
+        METRICS.set('page_size', self.size)
+
+    def fit(self, size):
+        """
+        Biggest size of the sequence not over `size`
+        """
+        fitted = self.minimum
+        while fitted * 2 <= min(size, self.maximum):
+            fitted *= 2
+        return fitted
+
+    def resize(self, size, reason):
+        if size != self.size:
+            logger.info('Page size {} -> {}, {}'.format(self.size, size, reason))
+            self.size = size
+            METRICS.set('page_size', size)
+
+    def observe(self, size, seconds, length):
+        """
+        Adapts to a page of `size` tickets that took `seconds` to respond
+        with `length` bytes
+        """
+        if seconds > self.target or length > self.max_bytes:
+            self.resize(min(self.size, max(self.minimum, size // 2)), 'slow or big page')
+        elif size >= self.size and seconds < self.target / 2 and length * 2 <= self.max_bytes:
+            self.resize(min(self.maximum, size * 2), 'fast page')
+
+    def shrink(self, size):
+        """
+        After a page of `size` tickets timed out or failed half way
+        """
+        self.resize(min(self.size, max(self.minimum, size // 2)), 'failed page')
+
+    def limit(self, per_page):
+        """
+        The API returned `per_page` tickets at most, a lower cap than ours.
+        Returns True when that is below the smallest size, or the size is
+        fixed, so every size becomes `per_page` and the pages asked for so
+        far can't be split in pages of it.
+        """
+        if per_page < self.minimum:
+            self.minimum = self.maximum = per_page
+            self.resize(per_page, 'the API returns {} at most'.format(per_page))
+            return True
+        self.maximum = self.fit(per_page)
+        self.resize(min(self.size, self.maximum), 'the API returns {} at most'.format(per_page))
+        return False
+
+
+class CountingReader(object):
+    def __init__(self, raw):
+        self.raw = raw
+        self.length = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.length += len(data)
+        return data
+
+
+class TicketPage(object):
+    """
+    Tickets `offset` to `offset + size` of the listing but the first `skip`
+    ones. Iterating it yields them as they are decoded, `total` and the
+    other values of the response are known once it is consumed.
+    """
+    def __init__(self, offset, size, response, stream=False, skip=0):
+        self.offset = offset
+        self.size = size
+        self.seconds = response.elapsed.total_seconds()
+        self.values = {}
+        # Tickets decoded and yielded
+        self.decoded = 0
+        self.count = 0
+        self.length = 0
+        self.failed = None
+        if stream:
+            items = self.decode(response)
+        else:
+            data = serializer.loads(response.content)
+            self.length = len(response.content)
+            self.values = dict((key, value) for key, value in data.items() if key != 'tickets')
+            items = iter(data['tickets'])
+        self.tickets = self.iterate(items, skip)
+
+    @property
+    def page(self):
+        return self.offset // self.size + 1
+
+    @property
+    def total(self):
+        """
+        Tickets in the listing, None if the page failed before telling
+        """
+        if 'total' in self.values:
+            return self.values['total']
+        if 'total_pages' in self.values:
+            return self.values['total_pages'] * self.values.get('per_page', self.size)
+        return None
+
+    @property
+    def capped(self):
+        """
+        Whether the API answered with smaller pages than asked, so these
+        are the tickets of another page
+        """
+        per_page = self.values.get('per_page')
+        return per_page is not None and per_page < self.size
+
+    def __iter__(self):
+        return self.tickets
+
+    def iterate(self, items, skip):
+        for ticket in items:
+            self.decoded += 1
+            if self.decoded > skip and not self.capped:
+                self.count += 1
+                yield ticket
+
+    def decode(self, response):
+        response.raw.decode_content = True
+        reader = CountingReader(response.raw)
+        try:
+            for ticket in serializer.iter_items(reader, 'tickets', self.values):
+                yield ticket
+        except STREAM_ERRORS as e:
+            self.failed = e
+        finally:
+            self.length = reader.length
+            response.close()
+
+    def finish(self):
+        """
+        Decodes the tickets left so the values of the response are known
+        """
+        for _ in self.tickets:
+            pass
@@ -0,0 +1,142 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+# Status codes worth retrying, the first ones mean we are being throttled
+THROTTLE_STATUS = (429, 503)
+RETRY_STATUS = THROTTLE_STATUS + (500, 502, 504)
+
+
+def retry_after(headers):
+    """
+    Seconds to wait from a Retry-After header, either seconds or a date
+    """
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+def backoff_delay(attempt, base, cap):
+    """
+    Exponential backoff with full jitter
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class AIMDLimit(object):
+    """
+    Additive increase, multiplicative decrease concurrency limit: it grows
+    by one request every `limit` successful requests and halves when the API
+    throttles us. Requests sent before the last decrease don't decrease it
+    again so a burst of 429s only counts once.
+    """
+    def __init__(self, config, maximum):
+        self.maximum = maximum
+        self.minimum = min(config.get('min_concurrency', 1), maximum)
+        self.limit = float(min(config.get('initial_concurrency', 10), maximum))
+        self.retries = config.get('retries', 5)
+        self.backoff = config.get('backoff', 1)
+        self.backoff_max = config.get('backoff_max', 60)
+        self.in_flight = 0
+        self.paused_until = 0
+        self.last_decrease = 0
+        self.throttled = 0
+        self.retried = 0
+
+    def can_start(self):
+        return self.in_flight < int(self.limit) and time.time() >= self.paused_until
+
+    def wait_time(self):
+        """
+        Seconds left of a pause, None to wait until a request finishes
+        """
+        pause = self.paused_until - time.time()
+        return pause if pause > 0 else None
+
+    def success(self):
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def throttle(self, started, pause=None):
+        self.throttled += 1
+        if started >= self.last_decrease:
+            self.limit = max(self.minimum, self.limit / 2)
+            self.last_decrease = time.time()
+        if pause:
+            self.paused_until = max(self.paused_until, time.time() + pause)
+
+    def delay(self, attempt, status=None, headers={}):
+        """
+        Seconds to wait before retrying a failed request, None if it
+        should not be retried
+        """
+        if attempt >= self.retries or (status is not None and status not in RETRY_STATUS):
+            return None
+        self.retried += 1
+        pause = retry_after(headers)
+        if pause is not None:
+            return pause
+        return backoff_delay(attempt, self.backoff, self.backoff_max)
+
+
+class RateLimiter(AIMDLimit):
+    """
+    AIMD limit shared by the threads of a process
+    """
+    def __init__(self, config, maximum):
+        super(RateLimiter, self).__init__(config, maximum)
+        self.condition = threading.Condition()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['condition']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while not self.can_start():
+                self.condition.wait(self.wait_time())
+            self.in_flight += 1
+            return time.time()
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+
+class AsyncRateLimiter(AIMDLimit):
+    """
+    AIMD limit shared by the coroutines of an event loop
+    """
+    def __init__(self, config, maximum):
+        import asyncio
+
+        super(AsyncRateLimiter, self).__init__(config, maximum)
+        self.released = asyncio.Event()
+
+    async def acquire(self):
+        import asyncio
+
+        while not self.can_start():
+            self.released.clear()
+            try:
+                await asyncio.wait_for(self.released.wait(), self.wait_time())
+            except asyncio.TimeoutError:
+                pass
+        self.in_flight += 1
+        return time.time()
+
+    def release(self):
+        self.in_flight -= 1
+        self.released.set()
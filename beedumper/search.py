@@ -0,0 +1,185 @@
+"""
+Offline search over the exported tickets: a SQLite file in the export
+folder with the fields of every ticket and a FTS5 full text index of its
+subject, body, replies and comments.
+"""
+import sqlite3
+from datetime import datetime, timezone
+from pathlib import Path
+
+from beedumper.state import activity_timestamp
+from beedumper.storage import KINDS
+
+SEARCH_FILE = 'search.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tickets (
+    id INTEGER PRIMARY KEY,
+    subject TEXT,
+    requester_name TEXT,
+    requester_email TEXT COLLATE NOCASE,
+    created_at REAL,
+    last_activity_at REAL,
+    signature TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tickets_created ON tickets (created_at);
+CREATE INDEX IF NOT EXISTS tickets_requester ON tickets (requester_email);
+CREATE TABLE IF NOT EXISTS labels (
+    id INTEGER NOT NULL,
+    label TEXT NOT NULL COLLATE NOCASE,
+    PRIMARY KEY (id, label)
+);
+CREATE INDEX IF NOT EXISTS labels_label ON labels (label);
+CREATE VIRTUAL TABLE IF NOT EXISTS documents USING fts5(subject, body, replies, comments, requester);
+"""
+
+
+def timestamp(value):
+    """
+    Epoch seconds of an ISO date, None if there is no date
+    """
+    if not value:
+        return None
+    import dateutil.parser
+    return dateutil.parser.parse(value).timestamp()
+
+def texts(items):
+    """
+    Text of the replies or comments of a ticket
+    """
+    return '\n'.join((item.get('content') or {}).get('text') or '' for item in items or [])
+
+def quote(value):
+    return '"{}"'.format(value.replace('"', '""'))
+
+
+class SearchIndex(object):
+    """
+    Search index stored in the export folder. Every ticket keeps the
+    signature of its stored documents, so updating the index only parses
+    the tickets whose ticket, replies or comments changed.
+    """
+    def __init__(self, export_folder):
+        self.path = Path(export_folder).joinpath(SEARCH_FILE)
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def signature(self, folder, storage):
+        return '|'.join(str(storage.version(folder, kind)) for kind in KINDS)
+
+    def add(self, folder, storage, signature):
+        ticket = storage.read(folder, 'ticket')
+        replies = storage.read(folder, 'replies') if storage.exists(folder, 'replies') else []
+        comments = storage.read(folder, 'comments') if storage.exists(folder, 'comments') else []
+        requester = ticket.get('requester') or {}
+        id = int(ticket['id'])
+
+        self.remove(id)
+        self.connection.execute(
+            'INSERT INTO tickets (id, subject, requester_name, requester_email, created_at, last_activity_at, signature) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (id, ticket.get('subject'), requester.get('name'), requester.get('email'),
+             timestamp(ticket.get('created_at')), activity_timestamp(ticket), signature))
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO labels (id, label) VALUES (?, ?)',
+            [(id, label['name']) for label in ticket.get('labels') or [] if label.get('name')])
+        self.connection.execute(
+            'INSERT INTO documents (rowid, subject, body, replies, comments, requester) VALUES (?, ?, ?, ?, ?, ?)',
+            (id, ticket.get('subject') or '', (ticket.get('content') or {}).get('text') or '',
+             texts(replies), texts(comments),
+             '{} {}'.format(requester.get('name') or '', requester.get('email') or '')))
+
+    def remove(self, id):
+        self.connection.execute('DELETE FROM tickets WHERE id = ?', (id,))
+        self.connection.execute('DELETE FROM labels WHERE id = ?', (id,))
+        self.connection.execute('DELETE FROM documents WHERE rowid = ?', (id,))
+
+    def update(self, folders, storage, progress=None):
+        """
+        Indexes the ticket folders whose documents changed and removes the
+        tickets not stored anymore. Returns the tickets indexed, unchanged
+        and removed.
+        """
+        signatures = dict(self.connection.execute('SELECT id, signature FROM tickets'))
+        indexed = unchanged = 0
+        for folder in folders:
+            id = int(folder.name)
+            signature = self.signature(folder, storage)
+            if signatures.pop(id, None) == signature:
+                unchanged += 1
+            else:
+                self.add(folder, storage, signature)
+                indexed += 1
+                if indexed % 1000 == 0:
+                    self.connection.commit()
+            if progress is not None:
+                progress(1)
+
+        # Whatever is left was not found in the export
+        for id in signatures:
+            self.remove(id)
+        self.connection.commit()
+        return indexed, unchanged, len(signatures)
+
+    def search(self, text=None, requester=None, label=None, since_date=None, until_date=None, limit=20):
+        """
+        Tickets matching all the filters, the best text matches first and
+        the most recent otherwise. `text` uses the FTS5 query syntax.
+        """
+        match = []
+        if text:
+            match.append('({})'.format(text))
+        conditions = []
+        params = []
+        if requester:
+            if '@' in requester:
+                conditions.append('t.requester_email = ?')
+                params.append(requester)
+            else:
+                match.append('requester : {}'.format(quote(requester)))
+        if label:
+            conditions.append('t.id IN (SELECT id FROM labels WHERE label = ?)')
+            params.append(label)
+        if since_date is not None:
+            conditions.append('t.created_at >= ?')
+            params.append(since_date.timestamp())
+        if until_date is not None:
+            conditions.append('t.created_at < ?')
+            params.append(until_date.timestamp())
+
+        if match:
+            query = ("SELECT t.id, t.subject, t.requester_name, t.requester_email, t.created_at, "
+                     "snippet(documents, -1, '[', ']', '...', 12) FROM documents "
+                     "JOIN tickets t ON t.id = documents.rowid WHERE documents MATCH ?")
+            params.insert(0, ' AND '.join(match))
+            order = 'rank'
+        else:
+            query = ('SELECT t.id, t.subject, t.requester_name, t.requester_email, t.created_at, NULL '
+                     'FROM tickets t WHERE 1')
+            order = 't.created_at DESC'
+        for condition in conditions:
+            query += ' AND ' + condition
+        query += ' ORDER BY {} LIMIT ?'.format(order)
+        params.append(limit)
+
+        for id, subject, name, email, created_at, snippet in self.connection.execute(query, params):
+            yield {
+                'id': id,
+                'subject': subject,
+                'requester': {'name': name, 'email': email},
+                'created_at': datetime.fromtimestamp(created_at, timezone.utc).isoformat() if created_at else None,
+                'snippet': snippet,
+            }
+
+    def __len__(self):
+        return self.connection.execute('SELECT count(*) FROM tickets').fetchone()[0]
@@ -0,0 +1,119 @@
+"""
+JSON encoding and decoding using orjson when it is installed and the
+standard library otherwise. Documents are always handled as bytes so
+files are read and written without intermediate strings.
+
+Files are written aside and renamed once complete so an interrupted run
+never leaves a truncated document.
+
+Big responses can be decoded item by item with ijson when it is installed.
+"""
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    def dumps(obj):
+        return orjson.dumps(obj)
+
+    def loads(data):
+        return orjson.loads(data)
+else:
+    def dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def loads(data):
+        return json.loads(data)
+
+
+@contextmanager
+def atomic_writer(path):
+    """
+    Binary file object that replaces `path` when the block completes
+    """
+    temp = path.with_name('.{}.{}.{}.tmp'.format(path.name, os.getpid(), threading.get_ident()))
+    try:
+        with temp.open('wb') as writer:
+            yield writer
+        os.replace(str(temp), str(path))
+    except BaseException:
+        if temp.exists():
+            temp.unlink()
+        raise
+
+def dump_file(path, obj):
+    with atomic_writer(path) as writer:
+        writer.write(dumps(obj))
+
+def dump_list_file(path, pages):
+    """
+    Writes the items of an iterable of pages as a single JSON list keeping
+    one page in memory at a time, returns the number of items
+    """
+    count = 0
+    with atomic_writer(path) as writer:
+        writer.write(b'[')
+        for page in pages:
+            for item in page:
+                if count:
+                    writer.write(b',')
+                writer.write(dumps(item))
+                count += 1
+        writer.write(b']')
+    return count
+
+def streaming():
+    """
+    Whether ijson is installed to decode streams incrementally
+    """
+    try:
+        import ijson
+    except ImportError:
+        return False
+    return True
+
+def iter_items(stream, key, values):
+    """
+    Yields the items of the `key` list of the JSON object read from a
+    binary stream as they are decoded, storing the other top level values
+    in the `values` dict. Raises ValueError on invalid or truncated JSON.
+    """
+    import ijson
+    from ijson.common import ObjectBuilder
+
+    prefix = key + '.item'
+    builder = None
+    depth = 0
+    try:
+        for path, event, value in ijson.parse(stream, use_float=True):
+            if builder is not None:
+                builder.event(event, value)
+                if event in ('start_map', 'start_array'):
+                    depth += 1
+                elif event in ('end_map', 'end_array'):
+                    depth -= 1
+                    if depth == 0:
+                        yield builder.value
+                        builder = None
+            elif path == prefix:
+                if event in ('start_map', 'start_array'):
+                    builder = ObjectBuilder()
+                    builder.event(event, value)
+                    depth = 1
+                else:
+                    yield value
+            elif '.' not in path and event not in ('map_key', 'start_map', 'end_map', 'start_array', 'end_array'):
+                values[path] = value
+    except ijson.JSONError as e:
+        raise ValueError(str(e))
+
+def load_file(path):
+    with path.open('rb') as reader:
+        return loads(reader.read())
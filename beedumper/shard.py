@@ -0,0 +1,72 @@
+"""
+Sharded exports: every host processes the tickets whose id modulus the
+number of shards matches its shard, into a shared export folder or into
+its own folder merged afterwards.
+"""
+import shutil
+from pathlib import Path
+
+from beedumper.storage import ARCHIVE_FILE, KINDS, ArchiveStorage, FolderStorage, ticket_folder
+
+ATTACHMENT_FOLDERS = ['attachments', 'attachments_replies']
+
+
+def parse_shard(value):
+    """
+    (shard, shards) from a `i/N` string, shards are numbered from 1
+    """
+    try:
+        shard, shards = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise ValueError('Use i/N, like 1/4')
+    if shards < 1 or not 1 <= shard <= shards:
+        raise ValueError('The shard must be between 1 and {}'.format(max(shards, 1)))
+    return shard, shards
+
+def in_shard(ticket_id, shard):
+    return shard is None or int(ticket_id) % shard[1] == shard[0] - 1
+
+def shard_of(ticket_id, shards):
+    return int(ticket_id) % shards + 1
+
+def folder_storage(export_folder):
+    """
+    Storage of an export folder, archive when it has one
+    """
+    if Path(export_folder).joinpath(ARCHIVE_FILE).exists():
+        return ArchiveStorage(export_folder)
+    return FolderStorage()
+
+def merge_export(source, destination, storage, index):
+    """
+    Copies the documents and attachments exported to the source folder
+    into the destination, skipping what is already there. Returns the
+    number of tickets merged.
+    """
+    source = Path(source)
+    source_storage = folder_storage(source)
+    total = 0
+    for folder in source_storage.ticket_folders(source):
+        target = ticket_folder(destination, folder.name)
+        for kind in KINDS:
+            if source_storage.exists(folder, kind):
+                obj = source_storage.read(folder, kind)
+                storage.write(target, kind, obj)
+                if kind == 'ticket':
+                    index.add(obj, target)
+
+        for name in ATTACHMENT_FOLDERS:
+            if not folder.joinpath(name).is_dir():
+                continue
+            for attachment in folder.joinpath(name).iterdir():
+                # Downloads left half way are not merged
+                if attachment.name.endswith('.part'):
+                    continue
+                copy = target.joinpath(name, attachment.name)
+                if not copy.exists() or copy.stat().st_size != attachment.stat().st_size:
+                    copy.parent.mkdir(parents=True, exist_ok=True)
+                    shutil.copyfile(str(attachment), str(copy))
+        total += 1
+    index.commit()
+    source_storage.close()
+    return total
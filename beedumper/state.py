@@ -0,0 +1,92 @@
+import sqlite3
+import time
+from pathlib import Path
+
+STATE_FILE = 'beedumper.sqlite'
+RESOURCES = ['replies', 'comments', 'attachments']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tickets (
+    id INTEGER PRIMARY KEY,
+    last_activity_at REAL NOT NULL,
+    replies_at REAL,
+    comments_at REAL,
+    attachments_at REAL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+def activity_timestamp(ticket):
+    """
+    Epoch seconds of the ticket last activity, now if it does not have one
+    """
+    import dateutil.parser
+
+    if 'last_activity_at' in ticket and ticket['last_activity_at'] != None:
+        return dateutil.parser.parse(ticket['last_activity_at']).timestamp()
+    else:
+        return time.time()
+
+
+class SyncState(object):
+    """
+    Sync state stored in the export folder. For every ticket it keeps its
+    last activity and when each of its sub resources was fetched, a resource
+    is out of date when it was fetched before the last activity of the ticket.
+    """
+    def __init__(self, export_folder):
+        self.path = Path(export_folder).joinpath(STATE_FILE)
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def commit(self):
+        self.connection.commit()
+
+    def get_watermark(self):
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'watermark'").fetchone()
+        return float(row[0]) if row else None
+
+    def set_watermark(self, timestamp):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('watermark', ?)", (str(timestamp),))
+        self.connection.commit()
+
+    def update_ticket(self, ticket):
+        self.connection.execute(
+            """INSERT INTO tickets (id, last_activity_at) VALUES (?, ?)
+               ON CONFLICT(id) DO UPDATE SET last_activity_at = excluded.last_activity_at""",
+            (int(ticket['id']), activity_timestamp(ticket)))
+
+    def is_stale(self, ticket_id, resource):
+        row = self.connection.execute(
+            'SELECT last_activity_at, {0}_at FROM tickets WHERE id = ?'.format(resource),
+            (int(ticket_id),)).fetchone()
+        return row is None or row[1] is None or row[1] < row[0]
+
+    def mark_fetched(self, ticket_id, resource, timestamp=None):
+        self.connection.execute(
+            'UPDATE tickets SET {0}_at = ? WHERE id = ?'.format(resource),
+            (timestamp or time.time(), int(ticket_id)))
+
+    def stale_tickets(self):
+        """
+        Ids of the tickets with any sub resource out of date
+        """
+        conditions = ' OR '.join(
+            '{0}_at IS NULL OR {0}_at < last_activity_at'.format(resource) for resource in RESOURCES)
+        rows = self.connection.execute('SELECT id FROM tickets WHERE ' + conditions).fetchall()
+        return [row[0] for row in rows]
@@ -0,0 +1,190 @@
+import gzip
+import sqlite3
+import zlib
+from pathlib import Path
+
+from beedumper import serializer
+from beedumper.metrics import METRICS
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARCHIVE_FILE = 'archive.sqlite'
+KINDS = ['ticket', 'replies', 'comments']
+
+
+def ticket_folder(base_directory, id):
+    """
+    Folder of a ticket, under the modulus of its id by 99
+    """
+    id = int(id)
+    return base_directory.joinpath('tickets').joinpath(str(id % 99).zfill(2)).joinpath(str(id))
+
+def get_storage(config):
+    """
+    Storage backend for the ticket, replies and comments documents selected
+    with the `storage` setting, `folder` by default
+    """
+    backend = config.get('storage', 'folder')
+    if backend == 'folder':
+        return FolderStorage()
+    elif backend == 'archive':
+        return ArchiveStorage(config['export_folder'], config.get('storage_compression', 'zstd'))
+    else:
+        raise Exception('Unknown storage {}'.format(backend))
+
+
+class FolderStorage(object):
+    """
+    One JSON file per document in the ticket folder.
+
+    Writes return False and leave the file untouched when it already holds
+    the same document, so unchanged files keep their modification time.
+    """
+    def path(self, folder, kind):
+        return folder.joinpath(kind + '.json')
+
+    def read(self, folder, kind):
+        return serializer.load_file(self.path(folder, kind))
+
+    def write(self, folder, kind, obj):
+        data = serializer.dumps(obj)
+        path = self.path(folder, kind)
+        try:
+            # Only read the file when the size matches
+            if path.stat().st_size == len(data) and path.read_bytes() == data:
+                METRICS.inc('writes_avoided', kind=kind)
+                return False
+        except FileNotFoundError:
+            folder.mkdir(parents=True, exist_ok=True)
+        with serializer.atomic_writer(path) as writer:
+            writer.write(data)
+        return True
+
+    def exists(self, folder, kind):
+        return self.path(folder, kind).exists()
+
+    def version(self, folder, kind):
+        """
+        Changes whenever the document is written, None if it does not exist
+        """
+        try:
+            stat = self.path(folder, kind).stat()
+        except FileNotFoundError:
+            return None
+        return '{}:{}'.format(stat.st_mtime_ns, stat.st_size)
+
+    def has_tickets(self, base_directory):
+        return base_directory.joinpath('tickets').exists()
+
+    def ticket_folders(self, base_directory):
+        for ticket_file in base_directory.joinpath('tickets').glob('**/ticket.json'):
+            yield ticket_file.parent
+
+    def close(self):
+        pass
+
+
+def compress(data, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    elif codec == 'gzip':
+        return gzip.compress(data)
+    return data
+
+def decompress(data, codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise Exception('Documents compressed with zstd need the zstandard package, '
+                            'pip install beedumper[zstd]')
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif codec == 'gzip':
+        return gzip.decompress(data)
+    return data
+
+
+class ArchiveStorage(object):
+    """
+    All the documents compressed in a single SQLite file, keyed by ticket id
+    and kind so reading a ticket is a primary key lookup. Ticket folders are
+    only created for the attachments.
+
+    The codec is stored with every document so the compression setting can
+    change between runs. The connection is opened lazily so the storage can
+    be sent to the pool workers.
+    """
+    def __init__(self, export_folder, compression='zstd'):
+        self.path = Path(export_folder).joinpath(ARCHIVE_FILE)
+        if compression == 'zstd' and zstandard is None:
+            compression = 'gzip'
+        self.compression = compression
+        self._connection = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        return state
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(str(self.path), timeout=60)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS documents (
+                    id INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    codec TEXT NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (id, kind)
+                )""")
+        return self._connection
+
+    def read(self, folder, kind):
+        row = self.connection.execute(
+            'SELECT codec, data FROM documents WHERE id = ? AND kind = ?', (int(folder.name), kind)).fetchone()
+        if row is None:
+            raise FileNotFoundError('No {} stored for ticket {}'.format(kind, folder.name))
+        return serializer.loads(decompress(row[1], row[0]))
+
+    def write(self, folder, kind, obj):
+        document = serializer.dumps(obj)
+        row = self.connection.execute(
+            'SELECT codec, data FROM documents WHERE id = ? AND kind = ?', (int(folder.name), kind)).fetchone()
+        if row is not None and decompress(row[1], row[0]) == document:
+            METRICS.inc('writes_avoided', kind=kind)
+            return False
+        data = compress(document, self.compression)
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO documents (id, kind, codec, data) VALUES (?, ?, ?, ?)',
+                (int(folder.name), kind, self.compression, data))
+        return True
+
+    def exists(self, folder, kind):
+        return self.connection.execute(
+            'SELECT 1 FROM documents WHERE id = ? AND kind = ?', (int(folder.name), kind)).fetchone() is not None
+
+    def version(self, folder, kind):
+        row = self.connection.execute(
+            'SELECT data FROM documents WHERE id = ? AND kind = ?', (int(folder.name), kind)).fetchone()
+        if row is None:
+            return None
+        return '{}:{}'.format(len(row[0]), zlib.crc32(row[0]))
+
+    def has_tickets(self, base_directory):
+        return self.path.exists()
+
+    def ticket_folders(self, base_directory):
+        rows = self.connection.execute("SELECT id FROM documents WHERE kind = 'ticket'").fetchall()
+        for row in rows:
+            yield ticket_folder(base_directory, row[0])
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,108 @@
+"""
+Integrity checks of an export: every document stored must parse, every
+ticket must have its replies and comments, and every attachment must be
+on disk with the size the API reported. The problems found are written
+to a repair manifest, a JSON object per line, for the repair command to
+fetch again only what is broken.
+"""
+from collections import Counter
+from pathlib import Path
+
+from beedumper import serializer
+
+MANIFEST_FILE = 'repair.jsonl'
+
+MISSING = 'missing'
+CORRUPT = 'corrupt'
+SIZE = 'size'
+
+
+def read_document(folder, kind, storage, problems):
+    """
+    The stored document, None after adding its problem if it is missing or
+    does not parse
+    """
+    if not storage.exists(folder, kind):
+        problems.append({'id': int(folder.name), 'kind': kind, 'problem': MISSING})
+        return None
+    try:
+        return storage.read(folder, kind)
+    except Exception as e:
+        problems.append({'id': int(folder.name), 'kind': kind, 'problem': CORRUPT, 'error': str(e)})
+        return None
+
+def attachments(folder, ticket, replies):
+    """
+    Yields (attachment, file) of a ticket and its replies
+    """
+    for attachment in ticket['content']['attachments']:
+        yield attachment, folder.joinpath('attachments', attachment['filename'])
+    for reply in replies or []:
+        if 'content' in reply:
+            for attachment in reply['content']['attachments']:
+                yield attachment, folder.joinpath('attachments_replies', attachment['filename'])
+
+def verify_ticket(folder, storage):
+    """
+    Problems of the ticket stored in the folder. The attachments of the
+    replies are only checked when the replies parse.
+    """
+    problems = []
+    ticket = read_document(folder, 'ticket', storage, problems)
+    replies = read_document(folder, 'replies', storage, problems)
+    read_document(folder, 'comments', storage, problems)
+    if ticket is None:
+        return problems
+
+    for attachment, attachment_file in attachments(folder, ticket, replies):
+        problem = {
+            'id': int(folder.name),
+            'kind': 'attachment',
+            'path': str(attachment_file.relative_to(folder)),
+            'url': attachment['url']['original'],
+        }
+        try:
+            size = attachment_file.stat().st_size
+        except FileNotFoundError:
+            problems.append(dict(problem, problem=MISSING))
+            continue
+        expected = attachment.get('filesize')
+        if expected is not None and size != int(expected):
+            problems.append(dict(problem, problem=SIZE, size=size, expected=int(expected)))
+    return problems
+
+
+class Manifest(object):
+    """
+    Writes the problems of every ticket to the manifest file object as they
+    are found and counts them by kind and problem
+    """
+    def __init__(self, writer):
+        self.writer = writer
+        self.tickets = 0
+        self.broken = 0
+        self.counts = Counter()
+
+    def add(self, problems):
+        self.tickets += 1
+        if problems:
+            self.broken += 1
+        for problem in problems:
+            self.counts[(problem['kind'], problem['problem'])] += 1
+            self.writer.write(serializer.dumps(problem) + b'\n')
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+
+def read_manifest(path):
+    """
+    Problems of the manifest grouped by ticket id
+    """
+    tickets = {}
+    with Path(path).open('rb') as reader:
+        for line in reader:
+            if line.strip():
+                problem = serializer.loads(line)
+                tickets.setdefault(problem['id'], []).append(problem)
+    return tickets
@@ -0,0 +1,129 @@
+"""
+Runs beedumper commands against the local SupportBee mock and reports
+tickets/s, requests/s, bytes/s and the peak RSS of every command for
+every concurrency setting.
+
+    python benchmarks/bench.py --tickets 5000 --latency 0.05 --concurrency 10,50,100
+
+Every concurrency setting exports into a fresh temporary folder running
+the commands in order, so the replies, comments and attachments exports
+work on the tickets exported before them.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from urllib.request import urlopen
+
+import yaml
+
+sys.path.insert(0, str(Path(__file__).parent))
+from mock_server import make_server, add_arguments, server_options
+
+ROOT = Path(__file__).parent.parent
+DEFAULT_COMMANDS = [
+    'all-metadata',
+    'export-tickets',
+    'export-replies',
+    'export-comments',
+    'export-attachments',
+    'all-tickets --pipeline',
+]
+
+
+def mock_stats(server, reset=False):
+    with urlopen(server.url + ('/_reset' if reset else '/_stats')) as response:
+        return json.loads(response.read())
+
+def write_config(folder, server, concurrency, extra):
+    config = {
+        'url': server.url,
+        'token': 'benchmark',
+        'per_page': 100,
+        'export_folder': str(folder.joinpath('export')),
+        'download_threads': concurrency,
+        'async_concurrency': concurrency,
+        'pool_size': concurrency,
+        'timeout': 60,
+    }
+    config.update(extra)
+    config_file = folder.joinpath('config.yaml')
+    with config_file.open('w') as writer:
+        writer.write(yaml.dump({'SupportBee': config}))
+    return config_file
+
+def run_command(config_file, command):
+    """
+    Runs the command in a child process, returns the seconds it took and
+    its peak RSS in bytes, including the pool workers it waited for
+    """
+    args = [sys.executable, '-c', 'from beedumper.cli import cli; cli()', '-c', str(config_file)] + command.split()
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    start = time.perf_counter()
+    process = subprocess.Popen(args, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    process.returncode = code
+    if code != 0:
+        sys.stderr.write(stderr.decode('utf-8', 'replace'))
+    # ru_maxrss is in kilobytes on Linux
+    return elapsed, usage.ru_maxrss * 1024, code
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument('--concurrency', default='10,50', help='Comma separated concurrency settings')
+    parser.add_argument('--commands', default=','.join(DEFAULT_COMMANDS), help='Comma separated beedumper commands')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='Extra config.yaml setting, can be repeated')
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    extra = dict((key, yaml.safe_load(value)) for key, value in (item.split('=', 1) for item in args.set))
+    server = make_server(port=0, **server_options(args))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = []
+    row = '{:<28} {:>5} {:>9} {:>10} {:>10} {:>10} {:>9} {:>5}'
+    print(row.format('command', 'conc', 'seconds', 'tickets/s', 'requests/s', 'MB/s', 'RSS MB', 'exit'))
+    for concurrency in [int(value) for value in args.concurrency.split(',')]:
+        with tempfile.TemporaryDirectory(prefix='beedumper-bench-') as folder:
+            config_file = write_config(Path(folder), server, concurrency, extra)
+            for command in args.commands.split(','):
+                mock_stats(server, reset=True)
+                elapsed, rss, code = run_command(config_file, command)
+                stats = mock_stats(server)
+                result = {
+                    'command': command,
+                    'concurrency': concurrency,
+                    'seconds': elapsed,
+                    'tickets_per_second': args.tickets / elapsed,
+                    'requests_per_second': stats['requests'] / elapsed,
+                    'bytes_per_second': stats['bytes'] / elapsed,
+                    'peak_rss': rss,
+                    'exit_code': code,
+                    'server': stats,
+                }
+                results.append(result)
+                print(row.format(
+                    command, concurrency, '{:.2f}'.format(elapsed),
+                    '{:.1f}'.format(result['tickets_per_second']),
+                    '{:.1f}'.format(result['requests_per_second']),
+                    '{:.2f}'.format(result['bytes_per_second'] / 2 ** 20),
+                    '{:.1f}'.format(rss / 2 ** 20), code))
+
+    server.shutdown()
+    if args.json:
+        with open(args.json, 'w') as writer:
+            json.dump(results, writer, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Measures how fast the beedumper command starts: the wall time of
+`--help`, `--version` and the metadata commands against the local
+SupportBee mock, and the modules that take most of the import time.
+
+    python benchmarks/import_time.py --runs 20
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+from mock_server import make_server
+from bench import write_config
+
+ROOT = Path(__file__).parent.parent
+COMMAND = 'from beedumper.cli import cli; cli()'
+
+
+def run(args, env):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', COMMAND] + args, env=env,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+def import_times(args, env):
+    """
+    Cumulative microseconds of every module imported by the command,
+    from python -X importtime
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', COMMAND] + args, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        # Nested modules are indented, keep the top level ones
+        if not module.startswith('  '):
+            times[module.strip()] = int(cumulative)
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help='Runs of every command')
+    parser.add_argument('--top', type=int, default=10, help='Slowest top level imports to show')
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    server = make_server(port=0, tickets=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory(prefix='beedumper-import-') as folder:
+        config = ['-c', str(write_config(Path(folder), server, 1, {}))]
+        commands = [['--help'], ['--version'], config + ['labels'], config + ['all-metadata']]
+
+        row = '{:<20} {:>10} {:>10} {:>10}'
+        print(row.format('command', 'min ms', 'median ms', 'max ms'))
+        for command in commands:
+            times = [run(command, env) * 1000 for _ in range(args.runs)]
+            print(row.format(' '.join(command[2:] if command[0] == '-c' else command),
+                             '{:.1f}'.format(min(times)), '{:.1f}'.format(statistics.median(times)),
+                             '{:.1f}'.format(max(times))))
+
+        for command in [['--help'], config + ['labels']]:
+            times = import_times(command, env)
+            print('\nSlowest imports of {}, {:.1f} ms in total:'.format(
+                command[-1], sum(times.values()) / 1000))
+            for module, micros in sorted(times.items(), key=lambda item: -item[1])[:args.top]:
+                print('  {:<30} {:>8.1f} ms'.format(module, micros / 1000))
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+"""
+Local stand-in for the SupportBee API to measure beedumper without hitting
+a real account. Tickets, replies, comments and attachments are generated
+from the ticket id so any dataset size is served without using memory.
+
+    python benchmarks/mock_server.py --tickets 10000 --latency 0.05 --throttle-rate 0.01
+
+Then point the `url` of your config.yaml to http://127.0.0.1:8000
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+FIRST_ID = 1000
+START = datetime(2015, 1, 1, tzinfo=timezone.utc)
+METADATA = {
+    '/users': 'users',
+    '/labels': 'labels',
+    '/teams': 'teams',
+    '/snippets': 'snippets',
+    '/emails': 'forwarding_addresses',
+}
+
+
+def iso(date):
+    return date.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class Dataset(object):
+    def __init__(self, tickets, attachments_every, attachment_size, metadata_size, url):
+        self.tickets = tickets
+        self.attachments_every = attachments_every
+        self.attachment_size = attachment_size
+        self.metadata_size = metadata_size
+        self.url = url
+
+    def attachments(self, name):
+        return [{
+            'filename': '{}.bin'.format(name),
+            'filesize': self.attachment_size,
+            'url': {'original': '{}/attachments/{}'.format(self.url, name)}
+        }]
+
+    def ticket(self, index):
+        id = FIRST_ID + index
+        created = START + timedelta(hours=index)
+        has_attachments = self.attachments_every and index % self.attachments_every == 0
+        return {
+            'id': id,
+            'subject': 'Ticket {}'.format(id),
+            'created_at': iso(created),
+            'last_activity_at': iso(created + timedelta(days=1)),
+            'replies_count': 2,
+            'comments_count': 1,
+            'requester': {'name': 'Requester {}'.format(index % 50), 'email': 'requester{}@example.com'.format(index % 50)},
+            'labels': [{'name': 'label{}'.format(index % 7)}],
+            'content': {
+                'text': 'Ticket {} body text with some words to search'.format(id),
+                'html': '<p>Ticket {}</p>'.format(id),
+                'attachments': self.attachments('t{}'.format(id)) if has_attachments else []
+            }
+        }
+
+    def activity(self, index):
+        return START + timedelta(hours=index, days=1)
+
+    def replies(self, id):
+        return [{
+            'id': id * 10 + i,
+            'created_at': iso(START),
+            'content': {
+                'text': 'Reply {} to ticket {}'.format(i, id),
+                'attachments': self.attachments('r{}'.format(id)) if i == 0 and self.attachments_every and id % self.attachments_every == 0 else []
+            }
+        } for i in range(2)]
+
+    def comments(self, id):
+        return [{'id': id * 10, 'created_at': iso(START), 'content': {'text': 'Comment on ticket {}'.format(id)}}]
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes = 0
+            self.errors = 0
+            self.throttled = 0
+
+    def add(self, size, status):
+        with self.lock:
+            self.requests += 1
+            self.bytes += size
+            if status == 429:
+                self.throttled += 1
+            elif status >= 500:
+                self.errors += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {'requests': self.requests, 'bytes': self.bytes, 'errors': self.errors, 'throttled': self.throttled}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written apart, avoid waiting for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body=b'', content_type='application/json', headers={}):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        if not self.path.startswith('/_'):
+            self.server.stats.add(len(body), status)
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        query = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+        path = url.path
+
+        if path == '/_stats':
+            return self.send(200, server.stats.as_dict())
+        if path == '/_reset':
+            server.stats.reset()
+            return self.send(200, {})
+
+        if server.latency:
+            time.sleep(random.uniform(0.5, 1.5) * server.latency)
+        if random.random() < server.throttle_rate:
+            return self.send(429, {'error': 'Too many requests'}, headers={'Retry-After': str(server.retry_after)})
+        if random.random() < server.error_rate:
+            return self.send(500, {'error': 'Internal server error'})
+
+        dataset = server.dataset
+        parts = path.strip('/').split('/')
+
+        if path == '/tickets':
+            return self.tickets(query)
+        elif len(parts) == 2 and parts[0] == 'tickets':
+            index = int(parts[1]) - FIRST_ID
+            if index < 0 or index >= dataset.tickets:
+                return self.send(404, {'error': 'Not found'})
+            return self.send(200, {'ticket': dataset.ticket(index)})
+        elif len(parts) == 3 and parts[0] == 'tickets' and parts[2] in ('replies', 'comments'):
+            index = int(parts[1]) - FIRST_ID
+            if index < 0 or index >= dataset.tickets:
+                return self.send(404, {'error': 'Not found'})
+            data = dataset.replies(int(parts[1])) if parts[2] == 'replies' else dataset.comments(int(parts[1]))
+            return self.send(200, {parts[2]: data})
+        elif parts[0] == 'attachments':
+            return self.attachment()
+        elif path in METADATA:
+            return self.metadata(METADATA[path], query)
+        return self.send(404, {'error': 'Not found'})
+
+    def tickets(self, query):
+        dataset = self.server.dataset
+        per_page = min(int(query.get('per_page', 15)), self.server.max_per_page)
+        page = int(query.get('page', 1))
+
+        first = 0
+        if 'since' in query:
+            # Tickets are sorted by activity, an hour apart
+            since = datetime.fromisoformat(query['since'].replace('Z', '+00:00'))
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+            first = max(0, int((since - START - timedelta(days=1)).total_seconds() // 3600) + 1)
+        total = max(0, dataset.tickets - first)
+        total_pages = max(1, -(-total // per_page))
+
+        start = first + (page - 1) * per_page
+        end = min(dataset.tickets, start + per_page)
+        return self.send(200, {
+            'total': total,
+            'current_page': page,
+            'per_page': per_page,
+            'total_pages': total_pages,
+            'tickets': [dataset.ticket(index) for index in range(start, end)]
+        })
+
+    def metadata(self, key, query):
+        size = self.server.dataset.metadata_size
+        per_page = int(query.get('per_page', size or 1))
+        page = int(query.get('page', 1))
+        start = (page - 1) * per_page
+        items = [{'id': i, 'name': '{} {}'.format(key, i)} for i in range(start, min(size, start + per_page))]
+        return self.send(200, {
+            key: items,
+            'current_page': page,
+            'total_pages': max(1, -(-size // per_page)),
+            'total': size
+        })
+
+    def attachment(self):
+        size = self.server.dataset.attachment_size
+        body = (b'0123456789abcdef' * (size // 16 + 1))[:size]
+        range_header = self.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            start = int(range_header[6:].split('-')[0])
+            if start >= size:
+                return self.send(416, b'', 'application/octet-stream', {'Content-Range': 'bytes */{}'.format(size)})
+            return self.send(206, body[start:], 'application/octet-stream',
+                             {'Content-Range': 'bytes {}-{}/{}'.format(start, size - 1, size)})
+        return self.send(200, body, 'application/octet-stream')
+
+
+def make_server(host='127.0.0.1', port=8000, tickets=1000, latency=0.0, error_rate=0.0,
+                throttle_rate=0.0, retry_after=1, attachments_every=5, attachment_size=64 * 1024,
+                metadata_size=20, max_per_page=100):
+    ThreadingHTTPServer.request_queue_size = 1024
+    ThreadingHTTPServer.daemon_threads = True
+    server = ThreadingHTTPServer((host, port), Handler)
+    url = 'http://{}:{}'.format(host, server.server_address[1])
+    server.dataset = Dataset(tickets, attachments_every, attachment_size, metadata_size, url)
+    server.stats = Stats()
+    server.latency = latency
+    server.error_rate = error_rate
+    server.throttle_rate = throttle_rate
+    server.retry_after = retry_after
+    server.max_per_page = max_per_page
+    server.url = url
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument('--tickets', type=int, default=1000, help='Number of tickets of the account')
+    parser.add_argument('--latency', type=float, default=0.0, help='Mean seconds to answer every request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Ratio of requests answered with a 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Ratio of requests answered with a 429')
+    parser.add_argument('--retry-after', type=float, default=1, help='Retry-After seconds of the 429 responses')
+    parser.add_argument('--attachments-every', type=int, default=5, help='One of every N tickets has attachments, 0 for none')
+    parser.add_argument('--attachment-size', type=int, default=64 * 1024, help='Bytes of every attachment')
+    parser.add_argument('--metadata-size', type=int, default=20, help='Number of users, labels, teams...')
+    parser.add_argument('--max-per-page', type=int, default=100, help='Maximum tickets per page')
+
+
+def server_options(args):
+    return dict(
+        tickets=args.tickets, latency=args.latency, error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate, retry_after=args.retry_after,
+        attachments_every=args.attachments_every, attachment_size=args.attachment_size,
+        metadata_size=args.metadata_size, max_per_page=args.max_per_page)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, **server_options(args))
+    print('Serving a SupportBee mock with {} tickets at {}'.format(args.tickets, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass